@@ -0,0 +1,307 @@
+"""
+Локальная замена VK API для нагрузочного тестирования бота.
+
+Отвечает на методы, которые вызывает бот (messages.send, messages.delete,
+messages.removeChatUser, messages.getConversationsById, users.get,
+groups.getById, groups.getLongPollServer, execute), и раздаёт события
+через Bots Long Poll. Умеет:
+  - добавлять задержку к каждому ответу (--latency-ms, --jitter-ms);
+  - ограничивать частоту запросов, как настоящий VK (--rps-limit, ошибка 6);
+  - подмешивать ошибки с заданной вероятностью (--errors 6:0.01,9:0.01,15:0.005);
+  - генерировать события бесед с заданной частотой (--event-rate).
+
+Запуск:
+    python benchmarks/fake_vk_server.py --port 8081 --event-rate 200
+Чтобы бот ходил сюда, в config.py:
+    vk_api_url = "http://127.0.0.1:8081/method/"
+Счётчики сервера: GET /stats
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+GROUP_ID = 1
+PEER_OFFSET = 2000000000
+
+ERROR_MESSAGES = {
+    6: "Too many requests per second",
+    9: "Flood control",
+    15: "Access denied: no access to call this method",
+}
+
+class FakeVK:
+    def __init__(self, args):
+        self.args = args
+        self.host_url = f"http://{args.host}:{args.port}"
+        self.errors = self._parse_errors(args.errors)
+        self.calls = {}
+        self.injected_errors = {}
+        self.rate_limited = 0
+        self.events = deque(maxlen=args.event_buffer)
+        self.ts = 0
+        self.events_generated = 0
+        self.events_delivered = 0
+        self._new_events = asyncio.Event()
+        self._window_started = time.monotonic()
+        self._window_requests = 0
+        self._message_ids = 0
+        self._cmids = {}
+
+    @staticmethod
+    def _parse_errors(spec: str) -> dict:
+        errors = {}
+        for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+            code, probability = item.split(":")
+            errors[int(code)] = float(probability)
+        return errors
+
+    @staticmethod
+    def _ids(value) -> list:
+        return [int(i) for i in str(value).strip("[]").split(",") if i.strip().lstrip("-").isdigit()]
+
+    @staticmethod
+    def _error(code: int, message: str = None) -> dict:
+        return {"error": {"error_code": code, "error_msg": message or ERROR_MESSAGES.get(code, "Error"),
+                          "request_params": []}}
+
+    def _rate_limited(self) -> bool:
+        """Не больше rps_limit запросов в секунду, как у настоящего VK"""
+        if not self.args.rps_limit:
+            return False
+        now = time.monotonic()
+        if now - self._window_started >= 1:
+            self._window_started = now
+            self._window_requests = 0
+        self._window_requests += 1
+        return self._window_requests > self.args.rps_limit
+
+    def _injected_error(self):
+        for code, probability in self.errors.items():
+            if random.random() < probability:
+                self.injected_errors[code] = self.injected_errors.get(code, 0) + 1
+                return code
+        return None
+
+    # Методы API
+
+    def _call(self, method: str, params: dict):
+        """Результат метода или код ошибки (int)"""
+        if method == "messages.send":
+            self._message_ids += 1
+            if "peer_ids" in params:
+                return [self._sent(peer_id) for peer_id in self._ids(params["peer_ids"])]
+            return self._message_ids
+        if method == "messages.delete":
+            peer_id = self._ids(params.get("peer_id", 0))[0]
+            return [{"peer_id": peer_id, "conversation_message_id": cmid, "response": 1}
+                    for cmid in self._ids(params.get("cmids", ""))]
+        if method == "messages.removeChatUser":
+            return 1
+        if method == "users.get":
+            return [{"id": user_id if isinstance(user_id, int) else abs(hash(user_id)) % 10 ** 8,
+                     "first_name": f"Имя{user_id}", "last_name": f"Фамилия{user_id}"}
+                    for user_id in self._user_ids(params.get("user_ids", ""))]
+        if method == "groups.getById":
+            return {"groups": [{"id": GROUP_ID, "name": "fake", "screen_name": "fake",
+                                "is_closed": 0, "type": "group"}]}
+        if method == "groups.getLongPollServer":
+            return {"key": "fake", "server": f"{self.host_url}/longpoll", "ts": str(self.ts)}
+        if method == "messages.getConversationsById":
+            return {"count": 1, "items": [self._conversation(peer_id)
+                                          for peer_id in self._ids(params.get("peer_ids", ""))]}
+        return None
+
+    def _sent(self, peer_id: int) -> dict:
+        return {"peer_id": peer_id, "message_id": self._message_ids, "conversation_message_id": self._next_cmid(peer_id)}
+
+    @staticmethod
+    def _user_ids(value) -> list:
+        return [int(i) if i.lstrip("-").isdigit() else i
+                for i in (part.strip() for part in str(value).strip("[]").split(",")) if i]
+
+    @staticmethod
+    def _conversation(peer_id: int) -> dict:
+        acl = {key: True for key in ("can_change_info", "can_change_invite_link", "can_change_pin", "can_invite",
+                                     "can_promote_users", "can_see_invite_link", "can_moderate", "can_copy_chat",
+                                     "can_call", "can_use_mass_mentions")}
+        return {
+            "peer": {"id": peer_id, "type": "chat", "local_id": peer_id - PEER_OFFSET},
+            "last_message_id": 0, "last_conversation_message_id": 0, "in_read": 0, "out_read": 0, "version": 1,
+            "chat_settings": {"owner_id": 1, "title": "fake", "state": "in", "active_ids": [], "acl": acl}
+        }
+
+    def _execute(self, code: str):
+        """Разбирает код вида return [API.method({...}), ...]; так его собирает бот"""
+        decoder = json.JSONDecoder()
+        results, errors = [], []
+        position = code.find("API.")
+        while position != -1:
+            method_start = position + len("API.")
+            params_start = code.index("(", method_start)
+            method = code[method_start:params_start]
+            params, end = decoder.raw_decode(code, params_start + 1)
+            self.calls[method] = self.calls.get(method, 0) + 1
+            error_code = self._injected_error()
+            if error_code is None:
+                results.append(self._call(method, params))
+            else:
+                results.append(False)
+                errors.append({"method": method, "error_code": error_code,
+                               "error_msg": ERROR_MESSAGES.get(error_code, "Error")})
+            position = code.find("API.", end)
+        response = {"response": results}
+        if errors:
+            response["execute_errors"] = errors
+        return response
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if self.args.latency_ms or self.args.jitter_ms:
+            await asyncio.sleep((self.args.latency_ms + random.uniform(0, self.args.jitter_ms)) / 1000)
+
+        if self._rate_limited():
+            self.rate_limited += 1
+            return web.json_response(self._error(6))
+
+        if method == "execute":
+            return web.json_response(self._execute(params.get("code", "")))
+
+        error_code = self._injected_error()
+        if error_code is not None:
+            return web.json_response(self._error(error_code))
+
+        result = self._call(method, params)
+        if result is None:
+            return web.json_response(self._error(3, "Unknown method passed"))
+        return web.json_response({"response": result})
+
+    # Bots Long Poll
+
+    def _next_cmid(self, peer_id: int) -> int:
+        self._cmids[peer_id] = self._cmids.get(peer_id, 0) + 1
+        return self._cmids[peer_id]
+
+    def _make_event(self) -> dict:
+        args = self.args
+        peer_id = PEER_OFFSET + random.randint(1, args.chats)
+        from_id = random.randint(1000, 1000 + args.users - 1)
+        message = {
+            "date": int(time.time()), "from_id": from_id, "id": 0, "out": 0, "peer_id": peer_id,
+            "text": f"сообщение {self.events_generated}", "conversation_message_id": self._next_cmid(peer_id),
+            "fwd_messages": [], "important": False, "random_id": 0, "attachments": [],
+            "is_hidden": False, "version": 1
+        }
+        roll = random.random()
+        if roll < args.join_share:
+            message["text"] = ""
+            message["action"] = {"type": "chat_invite_user_by_link", "member_id": from_id}
+        elif roll < args.join_share + args.command_share:
+            message["text"] = random.choice(("/id", "/staff", "/warnlist", "/help"))
+        return {
+            "type": "message_new", "group_id": GROUP_ID, "event_id": f"fake{self.ts + 1}", "v": "5.199",
+            "object": {"message": message, "client_info": {
+                "button_actions": [], "keyboard": True, "inline_keyboard": True, "carousel": True, "lang_id": 0
+            }}
+        }
+
+    def push_event(self, event: dict):
+        self.ts += 1
+        self.events.append((self.ts, event))
+        self.events_generated += 1
+        self._new_events.set()
+
+    async def generate_events(self):
+        """Генерирует события с частотой event_rate в секунду"""
+        interval = 1 / self.args.event_rate
+        next_at = time.monotonic()
+        while True:
+            now = time.monotonic()
+            # Догоняем расписание пачкой, если цикл отстал
+            while next_at <= now:
+                self.push_event(self._make_event())
+                next_at += interval
+            await asyncio.sleep(next_at - now)
+
+    async def handle_longpoll(self, request: web.Request) -> web.Response:
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        try:
+            ts = int(params.get("ts", 0))
+        except ValueError:
+            return web.json_response({"failed": 2})
+        if self.events and ts < self.events[0][0] - 1:
+            # События вышли из буфера: клиент должен взять новый ts
+            return web.json_response({"failed": 1, "ts": str(self.ts)})
+
+        wait = min(float(params.get("wait", 25)), 90)
+        if ts >= self.ts:
+            self._new_events.clear()
+            try:
+                await asyncio.wait_for(self._new_events.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+        updates = [event for event_ts, event in self.events if event_ts > ts][:self.args.max_updates]
+        self.events_delivered += len(updates)
+        return web.json_response({"ts": str(ts + len(updates)), "updates": updates})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": self.calls,
+            "injected_errors": self.injected_errors,
+            "rate_limited": self.rate_limited,
+            "events_generated": self.events_generated,
+            "events_delivered": self.events_delivered,
+            "ts": self.ts
+        })
+
+async def start(args):
+    fake = FakeVK(args)
+    app = web.Application()
+    app.router.add_route("*", "/method/{method}", fake.handle_method)
+    app.router.add_route("*", "/longpoll", fake.handle_longpoll)
+    app.router.add_get("/stats", fake.handle_stats)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Фейковый VK API: {fake.host_url}/method/ (счётчики: {fake.host_url}/stats)")
+
+    if args.event_rate > 0:
+        await fake.generate_events()
+    else:
+        await asyncio.Event().wait()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Локальная замена VK API для нагрузочного тестирования")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка каждого ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Случайная добавка к задержке")
+    parser.add_argument("--rps-limit", type=int, default=20, help="Запросов в секунду до ошибки 6 (0 - без лимита)")
+    parser.add_argument("--errors", default="", help="Вероятности ошибок: код:доля через запятую, например 9:0.01,15:0.005")
+    parser.add_argument("--event-rate", type=float, default=0.0, help="Событий в секунду (0 - не генерировать)")
+    parser.add_argument("--chats", type=int, default=1, help="Количество бесед")
+    parser.add_argument("--users", type=int, default=500, help="Количество пользователей")
+    parser.add_argument("--join-share", type=float, default=0.02, help="Доля событий входа в беседу")
+    parser.add_argument("--command-share", type=float, default=0.05, help="Доля сообщений-команд")
+    parser.add_argument("--max-updates", type=int, default=100, help="Событий в одном ответе Long Poll")
+    parser.add_argument("--event-buffer", type=int, default=100000, help="Сколько последних событий хранить")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(start(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+"""
+Микробенчмарк шлюза сообщений: сколько стоит решение "мут / тишина / права"
+для одного обычного сообщения.
+
+"before" - те же запросы, что выполнял на каждое сообщение прежний обработчик:
+SELECT мута, DELETE всех истёкших мутов (по всей таблице) с commit, SELECT тишины,
+SELECT прав при включённой тишине и INSERT сообщения с commit.
+"after" - message_gate() плюс запись в буфер.
+
+Запуск из корня репозитория (нужен config.py, как и для самого бота):
+    python benchmarks/message_gate.py [--messages 5000]
+База создаётся во временном каталоге, к VK API запросы не отправляются.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+CHAT_ID = 1
+USERS = 50
+
+def _legacy_gate_tx(cursor, chat_id, user_id, cmid, now):
+    cursor.execute("SELECT end_time FROM mutes WHERE chat_id = ? AND user_id = ? AND end_time > ?",
+                   (chat_id, user_id, now))
+    if cursor.fetchone():
+        return main.GATE_DELETE_MUTED
+    cursor.execute("DELETE FROM mutes WHERE end_time <= ?", (now,))
+    cursor.connection.commit()
+    cursor.execute("SELECT silence FROM chats WHERE chat_id = ?", (chat_id,))
+    row = cursor.fetchone()
+    if row and row[0] == 1:
+        cursor.execute("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?",
+                       (user_id, chat_id))
+        level = cursor.fetchone()
+        if not level or not level[0]:
+            return main.GATE_DELETE_SILENCE
+    cursor.execute("INSERT OR IGNORE INTO messages (chat_id, user_id, cmid) VALUES (?, ?, ?)",
+                   (chat_id, user_id, cmid))
+    cursor.connection.commit()
+    return main.GATE_ALLOW
+
+def _legacy_gate(chat_id, user_id, cmid):
+    cursor = main.database.cursor()
+    try:
+        return _legacy_gate_tx(cursor, chat_id, user_id, cmid, int(time.time()))
+    finally:
+        cursor.close()
+
+async def run_before(count: int) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        # Каждый шаг прежнего обработчика был отдельным обращением к потоку БД
+        await main.db_call(_legacy_gate, CHAT_ID, i % USERS, 1_000_000 + i)
+    return time.perf_counter() - started
+
+async def run_after(count: int) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        action, _ = await main.message_gate(CHAT_ID, i % USERS)
+        if action == main.GATE_ALLOW:
+            main.message_buffer.add(CHAT_ID, i % USERS, 2_000_000 + i)
+    await main.message_buffer.flush()
+    return time.perf_counter() - started
+
+async def benchmark(count: int):
+    await main.db_execute(
+        "INSERT OR REPLACE INTO chats (chat_id, peer_id, owner_id, silence) VALUES (?, ?, ?, 0)",
+        (CHAT_ID, 2000000000 + CHAT_ID, 1)
+    )
+    await main.db_executemany(
+        "INSERT OR REPLACE INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
+        [(user_id, CHAT_ID, 1 if user_id % 10 == 0 else 0) for user_id in range(USERS)]
+    )
+    main.load_chat_states()
+
+    results = []
+    for silence in (0, 1):
+        await main.db_execute("UPDATE chats SET silence = ? WHERE chat_id = ?", (silence, CHAT_ID))
+        main.chat_states[CHAT_ID].silence = silence
+        before = await run_before(count)
+        after = await run_after(count)
+        results.append((silence, before, after))
+
+    print(f"{'тишина':>8} {'before, мкс':>14} {'after, мкс':>14} {'ускорение':>10}")
+    for silence, before, after in results:
+        print(f"{silence:>8} {before / count * 1e6:>14.1f} {after / count * 1e6:>14.1f} {before / after:>9.1f}x")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Микробенчмарк шлюза сообщений")
+    parser.add_argument("--messages", type=int, default=5000, help="Сообщений на сценарий")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    main.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    main.initialize_bot()
+    try:
+        asyncio.run(benchmark(args.messages))
+    finally:
+        main.shutdown_database()
@@ -0,0 +1,355 @@
+"""
+Сквозной бенчмарк: синтетические события беседы прогоняются через настоящий
+стек обработчиков (chat_dispatcher -> роутер vkbottle -> register_handlers ->
+combined_handler, check_ban_and_kick, команды) на временной базе SQLite (или на хранилище
+в памяти, --storage memory) и заглушке VK API.
+
+Для каждого сценария выводится пропускная способность (событий в секунду)
+и задержка обработки одного события p50/p95/p99. Результаты сохраняются
+в JSON, чтобы сравнивать прогоны между собой.
+
+Запуск из корня репозитория (нужен config.py, как и для самого бота):
+    python benchmarks/replay.py [--events 2000] [--concurrency 50]
+                                [--scenarios chatter,commands] [--storage sqlite|memory]
+                                [--output results.json]
+К настоящему VK API запросы не отправляются.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+CHAT_ID = 1
+PEER_ID = 2000000000 + CHAT_ID
+GROUP_ID = 1
+OWNER_ID = 100
+MODERATORS = range(101, 106)
+USERS = range(1000, 1200)
+BANNED = range(5000, 5050)
+
+CLIENT_INFO = {
+    "button_actions": [], "keyboard": True, "inline_keyboard": True,
+    "carousel": True, "lang_id": 0
+}
+
+class StubHTTPClient:
+    """
+    Заглушка HTTP-клиента vkbottle: отвечает на методы VK API, которые вызывает бот,
+    не выходя в сеть. latency - искусственная задержка каждого ответа
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+
+    @staticmethod
+    def _ids(value) -> list:
+        return [int(i) for i in str(value).strip("[]").split(",") if i.strip().lstrip("-").isdigit()]
+
+    def _execute(self, code: str) -> list:
+        """Разбирает код execute в том виде, в каком его собирает ExecuteBatcher"""
+        decoder = json.JSONDecoder()
+        results = []
+        position = code.find("API.")
+        while position != -1:
+            method_start = position + len("API.")
+            params_start = code.index("(", method_start)
+            params, end = decoder.raw_decode(code, params_start + 1)
+            results.append(self._respond(code[method_start:params_start], params))
+            position = code.find("API.", end)
+        return results
+
+    def _respond(self, method: str, data: dict):
+        if method == "execute":
+            return self._execute(data["code"])
+        if method == "users.get":
+            return [{"id": user_id, "first_name": f"Имя{user_id}", "last_name": f"Фамилия{user_id}"}
+                    for user_id in self._ids(data.get("user_ids", ""))]
+        if method == "groups.getById":
+            return {"groups": [{"id": GROUP_ID, "name": "bench", "screen_name": "bench",
+                                "is_closed": 0, "type": "group"}]}
+        if method == "messages.delete":
+            return [{"peer_id": PEER_ID, "conversation_message_id": cmid, "response": True}
+                    for cmid in self._ids(data.get("cmids", ""))]
+        if method == "messages.send" and "peer_ids" in data:
+            return [{"peer_id": peer_id, "message_id": 0, "conversation_message_id": 1}
+                    for peer_id in self._ids(data["peer_ids"])]
+        return 1
+
+    async def request_text(self, url: str, method: str = "GET", data: dict = None, **kwargs) -> str:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(data, str):
+            data = {key: values[0] for key, values in parse_qs(data).items()}
+        return json.dumps({"response": self._respond(api_method, dict(data or {}))})
+
+    async def request_json(self, *args, **kwargs) -> dict:
+        return json.loads(await self.request_text(*args, **kwargs))
+
+    async def close(self):
+        pass
+
+class EventFactory:
+    """Собирает сырые события Bots Long Poll так, как их присылает VK"""
+
+    def __init__(self):
+        self.cmid = 0
+
+    def message(self, from_id: int, text: str, action: dict = None) -> dict:
+        self.cmid += 1
+        message = {
+            "date": int(time.time()), "from_id": from_id, "id": 0, "out": 0, "peer_id": PEER_ID,
+            "text": text, "conversation_message_id": self.cmid, "fwd_messages": [],
+            "important": False, "random_id": 0, "attachments": [], "is_hidden": False, "version": 1
+        }
+        if action:
+            message["action"] = action
+        return {
+            "type": "message_new", "object": {"message": message, "client_info": CLIENT_INFO},
+            "group_id": GROUP_ID, "event_id": f"bench{self.cmid}", "v": "5.199"
+        }
+
+    def join(self, user_id: int) -> dict:
+        return self.message(user_id, "", {"type": "chat_invite_user_by_link", "member_id": user_id})
+
+def scenario_chatter(factory: EventFactory, count: int) -> list:
+    """Обычная переписка: тишина выключена, мутов нет"""
+    return [factory.message(USERS[i % len(USERS)], f"сообщение номер {i}") for i in range(count)]
+
+def scenario_muted(factory: EventFactory, count: int) -> list:
+    """Половина сообщений от замученных пользователей"""
+    return [factory.message(USERS[i % len(USERS)], f"сообщение номер {i}") for i in range(count)]
+
+def scenario_silence(factory: EventFactory, count: int) -> list:
+    """Режим тишины: каждое десятое сообщение от модератора, остальные удаляются"""
+    events = []
+    for i in range(count):
+        from_id = MODERATORS[i % len(MODERATORS)] if i % 10 == 0 else USERS[i % len(USERS)]
+        events.append(factory.message(from_id, f"сообщение номер {i}"))
+    return events
+
+def scenario_join_storm(factory: EventFactory, count: int) -> list:
+    """Массовый вход по ссылке, каждый пятый - забаненный"""
+    return [factory.join(BANNED[i % len(BANNED)] if i % 5 == 0 else 100000 + i) for i in range(count)]
+
+COMMAND_MIX = ["/id", "/staff", "/warnlist", "/nicklist", "/help", "/warnhistory [id1000|x]"]
+
+def scenario_commands(factory: EventFactory, count: int) -> list:
+    """Команды модераторов вперемешку с обычными сообщениями"""
+    events = []
+    for i in range(count):
+        if i % 2:
+            events.append(factory.message(USERS[i % len(USERS)], f"сообщение номер {i}"))
+        else:
+            events.append(factory.message(MODERATORS[i % len(MODERATORS)], COMMAND_MIX[i % len(COMMAND_MIX)]))
+    return events
+
+SCENARIOS = {
+    "chatter": scenario_chatter,
+    "muted": scenario_muted,
+    "silence": scenario_silence,
+    "join_storm": scenario_join_storm,
+    "commands": scenario_commands,
+}
+
+async def seed_database():
+    """Активированная беседа с модераторами, предупреждениями, никами и банами"""
+    await main.storage.create_chat(CHAT_ID, PEER_ID, OWNER_ID, "Владелец")
+    for user_id in MODERATORS:
+        await main.storage.set_permission(user_id, CHAT_ID, main.PERMISSION_LEVELS['ONE'])
+        await main.storage.set_nick(user_id, CHAT_ID, f"Модер{user_id}")
+    for i in range(50):
+        await main.storage.add_warn(CHAT_ID, USERS[i % 20], "флуд", MODERATORS[i % len(MODERATORS)])
+    for user_id in BANNED:
+        await main.storage.add_ban(CHAT_ID, user_id, None, "спам", OWNER_ID, int(time.time()))
+    main.load_chat_states()
+    main.load_bans()
+
+async def prepare_scenario(name: str):
+    """Сбрасывает состояние беседы под сценарий"""
+    state = main.chat_states[CHAT_ID]
+    state.silence = 1 if name == "silence" else 0
+    await main.storage.set_silence(CHAT_ID, state.silence)
+
+    for user_id in USERS:
+        await main.storage.remove_mute(CHAT_ID, user_id)
+        main.mute_registry.remove(CHAT_ID, user_id)
+    if name == "muted":
+        end_time = int(time.time()) + 3600
+        for user_id in USERS[::2]:
+            await main.storage.add_mute(CHAT_ID, user_id, end_time, "бенчмарк")
+            main.mute_registry.add(CHAT_ID, user_id, end_time)
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def run_scenario(name: str, count: int, concurrency: int, http_client: StubHTTPClient) -> dict:
+    await prepare_scenario(name)
+    events = SCENARIOS[name](EventFactory(), count)
+    latencies = []
+    calls_before = dict(http_client.calls)
+
+    # События идут через chat_dispatcher, как в боте: события одной беседы
+    # обрабатываются по очереди. Задержка - время обработки одного события
+    # без ожидания в очереди беседы, а для входа в беседу - до конца обработки
+    # его пачки в join_batcher (кик забаненного, приветствие)
+    dispatcher = main.chat_dispatcher = main.ChatDispatcher(concurrency)
+    process_event = main.bot.process_event
+    process_joins = main.process_joins
+    join_started = {}  # user_id -> [начало обработки события входа, ...]
+
+    async def timed_process_event(event, api):
+        event_started = time.perf_counter()
+        action = event["object"]["message"].get("action") or {}
+        is_join = action.get("type") in ("chat_invite_user", "chat_invite_user_by_link")
+        if is_join:
+            join_started.setdefault(action["member_id"], []).append(event_started)
+        try:
+            await process_event(event, api)
+        finally:
+            if not is_join or not main.join_batcher.enabled:
+                latencies.append(time.perf_counter() - event_started)
+
+    async def timed_process_joins(chat_id, peer_id, user_ids):
+        try:
+            await process_joins(chat_id, peer_id, user_ids)
+        finally:
+            if main.join_batcher.enabled:
+                finished = time.perf_counter()
+                for user_id in user_ids:
+                    latencies.extend(finished - event_started for event_started in join_started.pop(user_id, []))
+
+    main.bot.process_event = timed_process_event
+    main.process_joins = timed_process_joins
+    started = time.perf_counter()
+    try:
+        for event in events:
+            dispatcher.submit(event, main.bot.api)
+        await dispatcher.close()
+        # Входы в беседу копятся в join_batcher: ждём конца окна, как в боте,
+        # и дожидаемся обработки последней пачки
+        if main.join_batcher.stats()["pending"]:
+            await asyncio.sleep(main.join_batcher.window)
+        await main.join_batcher.flush()
+        await main.message_buffer.flush()
+    finally:
+        del main.bot.process_event
+        main.process_joins = process_joins
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "events": count,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(count / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0
+        },
+        "vk_calls": {
+            method: calls - calls_before.get(method, 0)
+            for method, calls in http_client.calls.items()
+            if calls != calls_before.get(method, 0)
+        }
+    }
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+async def benchmark(args) -> dict:
+    http_client = StubHTTPClient(args.vk_latency_ms / 1000)
+    main.bot.api = main.ScheduledAPI(main.vk_token, http_client=http_client)
+    # Лимит частоты VK здесь не измеряется: бюджет запросов практически бесконечный
+    main.outbound_scheduler = main.OutboundScheduler(args.vk_rate, args.vk_rate)
+    main.register_handlers(main.bot)
+
+    await main.bot_context.get_group_id()
+    await seed_database()
+    flusher = asyncio.ensure_future(main.message_buffer.run())
+
+    results = []
+    try:
+        for name in args.scenarios:
+            result = await run_scenario(name, args.events, args.concurrency, http_client)
+            results.append(result)
+            latency = result["latency_ms"]
+            print(f"{name:>12}: {result['events_per_second']:>9.1f} событий/с  "
+                  f"p50 {latency['p50']:.2f} мс  p95 {latency['p95']:.2f} мс  p99 {latency['p99']:.2f} мс",
+                  file=sys.stderr)
+    finally:
+        flusher.cancel()
+
+    return {
+        "timestamp": int(time.time()),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "vk_latency_ms": args.vk_latency_ms,
+        "storage": args.storage,
+        "results": results
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк обработчиков бота")
+    parser.add_argument("--events", type=int, default=2000, help="Событий на сценарий")
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="Событий в обработке одновременно (max_concurrency chat_dispatcher)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Сценарии через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--vk-latency-ms", type=float, default=0.0, help="Задержка ответа заглушки VK API")
+    parser.add_argument("--vk-rate", type=float, default=1e9, help="Лимит запросов к VK API в секунду")
+    parser.add_argument("--storage", default="sqlite", choices=sorted(main.STORAGE_BACKENDS),
+                        help="Хранилище бота")
+    parser.add_argument("--output", help="Файл для JSON с результатами (по умолчанию - stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Не приглушать логи бота")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    main.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    main.storage = main.create_storage(args.storage)
+    main.initialize_bot()
+    try:
+        report = asyncio.run(benchmark(args))
+    finally:
+        main.shutdown_database()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -1,3 +1,4 @@
+import abc
 import re
 import time
 import urllib
@@ -7,154 +8,2565 @@ import logging
 import threading
 import os
 import asyncio
+import heapq
+import atexit
+import queue
+import random
+import signal
+import multiprocessing
 
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import wraps
-from vkbottle import Keyboard, Callback, KeyboardButtonColor, GroupEventType, GroupTypes, API, Text, User
+from functools import wraps, partial
+from logging.handlers import QueueHandler, QueueListener
+from aiohttp import web
+from vkbottle import Keyboard, Callback, KeyboardButtonColor, GroupEventType, GroupTypes, API, Text, User, VKAPIError
 from vkbottle.bot import Bot, Message, rules
+from vkbottle.polling import BotPolling
 from config import Config
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись лога - одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            entry['event'] = event
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging() -> QueueListener:
+    """
+    Логи пишутся отдельным потоком: обработчики только кладут в очередь записи,
+    отформатированные QueueHandler (аргументы и traceback фиксируются сразу).
+    Формат (text/json), уровень и файл задаются в config.py
+    """
+    if getattr(Config, 'log_format', 'text') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(LOG_FORMAT)
+    
+    log_file = getattr(Config, 'log_file', None)
+    output = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    output.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(getattr(Config, 'log_level', 'INFO'))
+    root.addHandler(QueueHandler(log_queue))
+    
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
-# Уровни прав пользователей
-PERMISSION_LEVELS = {
-    'ZERO': 0,      # Обычный пользователь
-    'ONE': 1, # Модератор (может использовать основные модераторские команды)
-    'TWO': 2,     # Администратор (расширенные права)
-    'THREE': 3,     # Владелец (почти полные права)
-    'FOUR': 4     #Разработчик (полные права)
+class LogSampler:
+    """
+    Выборочное логирование частых событий: для события задаётся доля записей,
+    которые попадут в лог (1.0 - все, 0 - ни одной)
+    """
+
+    DEFAULT_RATES = {
+        'message': 0.01,     # Каждое входящее сообщение
+        'chat_action': 1.0,  # Входы и выходы участников
+    }
+
+    def __init__(self, rates: dict = None):
+        self.rates = dict(self.DEFAULT_RATES)
+        self.rates.update(rates or {})
+
+    def sample(self, event: str) -> bool:
+        rate = self.rates.get(event, 1.0)
+        return rate >= 1.0 or (rate > 0 and random.random() < rate)
+
+log_sampler = LogSampler(getattr(Config, 'log_sample_rates', None))
+
+# Уровни прав пользователей
+PERMISSION_LEVELS = {
+    'ZERO': 0,      # Обычный пользователь
+    'ONE': 1, # Модератор (может использовать основные модераторские команды)
+    'TWO': 2,     # Администратор (расширенные права)
+    'THREE': 3,     # Владелец (почти полные права)
+    'FOUR': 4     #Разработчик (полные права)
+}
+
+# Глобальные переменные
+vk_token = Config.vk_token
+bot = None
+api = None
+database = None
+db_executor = None  # Отдельный поток, в котором выполняются все запросы к SQLite
+db_read_executor = None  # Пул потоков с read-only соединениями для тяжёлых чтений
+_db_read_local = threading.local()
+_db_read_connections = []
+
+# Настройки SQLite (можно переопределить в config.py)
+DATABASE_PATH = getattr(Config, 'database_path', 'database.db')
+DB_JOURNAL_MODE = getattr(Config, 'db_journal_mode', 'WAL')
+DB_SYNCHRONOUS = getattr(Config, 'db_synchronous', 'NORMAL')
+DB_CACHE_SIZE_KB = getattr(Config, 'db_cache_size_kb', 16384)
+DB_MMAP_SIZE = getattr(Config, 'db_mmap_size', 64 * 1024 * 1024)
+DB_BUSY_TIMEOUT_MS = getattr(Config, 'db_busy_timeout_ms', 5000)
+DB_READ_POOL_SIZE = getattr(Config, 'db_read_pool_size', 2)
+# VACUUM при миграции на auto_vacuum выполняется, только если база не больше этого размера
+DB_MIGRATION_VACUUM_MAX_MB = getattr(Config, 'db_migration_vacuum_max_mb', 100)
+# Хранилище: 'sqlite' или 'memory' (данные только в памяти процесса, для бенчмарков и проверок)
+STORAGE_BACKEND = getattr(Config, 'storage_backend', 'sqlite')
+bot_running = True
+
+# Шардирование по процессам: 0 - обычный режим в одном процессе
+WORKER_PROCESSES = getattr(Config, 'worker_processes', 0)
+SHARD_INDEX = None  # Номер шарда в процессе-обработчике
+SHARD_COUNT = 1
+
+def shard_for_peer(peer_id: int, shard_count: int) -> int:
+    """Номер шарда беседы; одна беседа всегда попадает в один и тот же процесс"""
+    return peer_id % shard_count
+
+def owns_chat(chat_id: int) -> bool:
+    """Обслуживает ли текущий процесс эту беседу"""
+    return SHARD_INDEX is None or shard_for_peer(2000000000 + chat_id, SHARD_COUNT) == SHARD_INDEX
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Гистограмма задержек в духе Prometheus: счётчики по корзинам, сумма и количество"""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Счётчики и гистограммы задержек, отдаются в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._gauges = {}      # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @staticmethod
+    def _format_labels(labels, extra: str = None) -> str:
+        parts = []
+        for label, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{label}="{value}"')
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items()
+            )
+        
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        
+        for (name, labels), value in gauges:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, counts):
+                cumulative += bucket_count
+                bucket_labels = self._format_labels(labels, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = self._format_labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{bucket_labels} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('vkbot_command_seconds', 'Время выполнения команды')
+metrics.describe('vkbot_db_query_seconds', 'Время запроса к SQLite, включая ожидание в очереди потока БД')
+metrics.describe('vkbot_vk_request_seconds', 'Время запроса к VK API')
+metrics.describe('vkbot_messages_total', 'Обработано сообщений')
+metrics.describe('vkbot_deleted_messages_total', 'Удалено сообщений')
+metrics.describe('vkbot_kicks_total', 'Исключения из бесед')
+metrics.describe('vkbot_errors_total', 'Ошибки по источникам')
+metrics.describe('vkbot_function_seconds', 'Время выполнения вспомогательных функций')
+metrics.describe('vkbot_vk_queue_depth', 'Запросы к VK API, ожидающие в очереди планировщика')
+
+def measure_latency(func):
+    """Пишет время выполнения корутины в vkbot_function_seconds"""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe('vkbot_function_seconds', time.perf_counter() - started, function=func.__name__)
+    return wrapper
+
+class ErrorCounterHandler(logging.Handler):
+    """Считает все записи лога уровня ERROR и выше"""
+
+    def emit(self, record):
+        metrics.inc('vkbot_errors_total', source='log')
+
+logger.addHandler(ErrorCounterHandler(logging.ERROR))
+
+DEFAULT_WELCOME_MESSAGE = 'Добро пожаловать в беседу!'
+
+# Коды ошибок VK API, после которых нужно заново получить данные о группе бота
+# (5 - авторизация не удалась, 27 - ошибка авторизации группы)
+GROUP_AUTH_ERROR_CODES = (5, 27)
+
+class BotContext:
+    """Данные о самом боте, которые получаются один раз и нужны обработчикам"""
+
+    def __init__(self):
+        self.group_id = None
+        self._resolve_lock = None
+
+    async def get_group_id(self) -> int:
+        """Возвращает ID группы бота, запрашивая его только при первом обращении"""
+        if self.group_id is not None:
+            return self.group_id
+        if self._resolve_lock is None:
+            self._resolve_lock = asyncio.Lock()
+        async with self._resolve_lock:
+            if self.group_id is None:
+                group_info = await bot.api.groups.get_by_id()
+                self.group_id = group_info.groups[0].id
+                logger.info(f"ID группы бота: {self.group_id}")
+        return self.group_id
+
+    def handle_api_error(self, error: Exception):
+        """Сбрасывает сохранённые данные, если ошибка говорит о смене авторизации"""
+        if isinstance(error, VKAPIError) and error.code in GROUP_AUTH_ERROR_CODES:
+            logger.warning(f"Ошибка авторизации VK API ({error.code}), ID группы будет получен заново")
+            self.group_id = None
+
+bot_context = BotContext()
+
+UserProfile = namedtuple('UserProfile', ['id', 'first_name', 'last_name'])
+
+class UserProfileResolver:
+    """
+    Кэш профилей пользователей VK с TTL.
+    Одновременные и пакетные запросы объединяются в вызовы users.get по 1000 ID,
+    удалённые и несуществующие аккаунты кэшируются как None (отрицательный кэш)
+    """
+
+    MAX_IDS_PER_REQUEST = 1000
+
+    def __init__(self, ttl: float = 3600, negative_ttl: float = 600, max_size: int = 50000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._cache = {}  # user_id -> (expires_at, UserProfile или None)
+        self._waiting = {}  # user_id -> Future, ID в очереди или в запросе
+        self._queue = []  # ID, которые уйдут в следующий users.get
+        self._flush_scheduled = False
+        self._flush_tasks = set()
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    def _get_cached(self, user_id: int, now: float):
+        """Возвращает (найдено, профиль)"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return False, None
+        expires_at, profile = entry
+        if expires_at <= now:
+            del self._cache[user_id]
+            return False, None
+        return True, profile
+
+    def _store(self, user_id: int, profile, now: float):
+        ttl = self.ttl if profile is not None else self.negative_ttl
+        self._cache.pop(user_id, None)
+        self._cache[user_id] = (now + ttl, profile)
+        while len(self._cache) > self.max_size:
+            # Вытесняем самую старую запись (словарь хранит порядок вставки)
+            del self._cache[next(iter(self._cache))]
+
+    async def get(self, user_id: int):
+        """Профиль пользователя или None, если его нет или он удалён"""
+        return (await self.get_many([user_id])).get(user_id)
+
+    async def get_many(self, user_ids) -> dict:
+        """
+        Профили сразу для всех user_ids (повторы и группы пропускаются)
+        :return: Словарь user_id -> UserProfile или None
+        """
+        now = time.monotonic()
+        result = {}
+        futures = {}
+        loop = asyncio.get_running_loop()
+        
+        for user_id in user_ids:
+            if user_id in result or user_id in futures or user_id is None or user_id <= 0:
+                continue
+            found, profile = self._get_cached(user_id, now)
+            if found:
+                self.hits += 1
+                result[user_id] = profile
+                continue
+            self.misses += 1
+            future = self._waiting.get(user_id)
+            if future is None:
+                future = loop.create_future()
+                self._waiting[user_id] = future
+                self._queue.append(user_id)
+            futures[user_id] = future
+        
+        if self._queue and not self._flush_scheduled:
+            # Запрос уходит на следующей итерации цикла, чтобы успели присоединиться
+            # другие корутины, запросившие профили в ту же итерацию
+            self._flush_scheduled = True
+            loop.call_soon(self._start_flush)
+        
+        for user_id, future in futures.items():
+            result[user_id] = await asyncio.shield(future)
+        return result
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self):
+        self._flush_scheduled = False
+        queue, self._queue = self._queue, []
+        chunks = [queue[i:i + self.MAX_IDS_PER_REQUEST] for i in range(0, len(queue), self.MAX_IDS_PER_REQUEST)]
+        await asyncio.gather(*(self._fetch(chunk) for chunk in chunks))
+
+    async def _fetch(self, user_ids: list):
+        profiles = {}
+        failed = False
+        try:
+            self.api_calls += 1
+            users = await bot.api.users.get(user_ids=user_ids)
+            for user in users or []:
+                # Удалённые и заблокированные аккаунты кэшируем как отсутствующие
+                if getattr(user, 'deactivated', None):
+                    continue
+                profiles[user.id] = UserProfile(user.id, user.first_name, user.last_name)
+        except Exception as e:
+            failed = True
+            logger.error(f"Ошибка при получении информации о пользователях {user_ids[:10]}: {e}")
+        
+        now = time.monotonic()
+        for user_id in user_ids:
+            profile = profiles.get(user_id)
+            # При ошибке запроса ничего не кэшируем, следующий вызов повторит попытку
+            if not failed:
+                self._store(user_id, profile, now)
+            future = self._waiting.pop(user_id, None)
+            if future is not None and not future.done():
+                future.set_result(profile)
+
+    def invalidate(self, user_id: int):
+        self._cache.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'api_calls': self.api_calls
+        }
+
+profile_resolver = UserProfileResolver(
+    getattr(Config, 'profile_cache_ttl', 3600),
+    getattr(Config, 'profile_negative_cache_ttl', 600)
+)
+
+# Код ошибки VK API "Неверный идентификатор пользователя"
+INVALID_USER_ID_ERROR_CODE = 113
+
+class ScreenNameResolver:
+    """
+    Кэш короткое имя -> ID пользователя (LRU с TTL, включая отрицательные ответы).
+    Одновременные запросы одного и того же имени склеиваются в один вызов users.get
+    """
+
+    def __init__(self, max_size: int = 5000, ttl: int = 3600, negative_ttl: int = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = OrderedDict()  # screen_name -> (user_id или None, expires_at)
+        self._waiting = {}  # screen_name -> future
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    async def resolve(self, screen_name: str):
+        """Возвращает ID пользователя по короткому имени или None, если такого нет"""
+        key = screen_name.lower()
+        cached = self._cache.get(key)
+        if cached is not None:
+            user_id, expires_at = cached
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return user_id
+            del self._cache[key]
+        self.misses += 1
+        
+        future = self._waiting.get(key)
+        if future is not None:
+            return await future
+        
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = future
+        try:
+            user_id = await self._fetch(key)
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже отдано вызывающему, ожидающие получат его же
+            future.exception()
+            raise
+        else:
+            future.set_result(user_id)
+            return user_id
+        finally:
+            del self._waiting[key]
+            # Задачу отменили (таймаут команды, остановка): ожидающие не должны висеть вечно
+            if not future.done():
+                future.cancel()
+
+    async def _fetch(self, key: str):
+        self.api_calls += 1
+        try:
+            users = await bot.api.users.get(user_ids=key)
+        except VKAPIError as e:
+            if e.code != INVALID_USER_ID_ERROR_CODE:
+                raise
+            users = []
+        
+        user_id = users[0].id if users else None
+        ttl = self.ttl if user_id is not None else self.negative_ttl
+        self._cache[key] = (user_id, time.monotonic() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return user_id
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'api_calls': self.api_calls
+        }
+
+screen_name_resolver = ScreenNameResolver(
+    getattr(Config, 'screen_name_cache_size', 5000),
+    getattr(Config, 'screen_name_cache_ttl', 3600),
+    getattr(Config, 'screen_name_negative_cache_ttl', 300)
+)
+
+# Приоритеты исходящих запросов к VK API (меньше - раньше)
+PRIORITY_ENFORCEMENT = 0  # Удаление сообщений и кики
+PRIORITY_DEFAULT = 1      # Служебные запросы: users.get, groups.getById и т.д.
+PRIORITY_REPLY = 2        # Ответы и приветственные сообщения
+
+METHOD_PRIORITIES = {
+    'messages.delete': PRIORITY_ENFORCEMENT,
+    'messages.removeChatUser': PRIORITY_ENFORCEMENT,
+    'messages.send': PRIORITY_REPLY,
+}
+
+# Код ошибки VK API "Слишком много запросов в секунду"
+TOO_MANY_REQUESTS_ERROR_CODE = 6
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_available(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def drain(self):
+        """Обнуляет запас, например после ошибки превышения лимита"""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+class OutboundScheduler:
+    """
+    Планировщик исходящих запросов к VK API: ограничивает частоту ведром токенов
+    и при нехватке бюджета выдаёт разрешения по приоритету, а не по порядку прихода
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        self._queue = []  # (priority, seq, enqueued_at, future)
+        self._seq = 0
+        self._dispatcher = None
+        # Метрики по приоритетам
+        self.granted = {}
+        self.queued = {}
+        self.wait_time_total = {}
+        self.wait_time_max = {}
+
+    def depth(self) -> dict:
+        depth = {}
+        for priority, seq, enqueued_at, future in self._queue:
+            if not future.done():
+                depth[priority] = depth.get(priority, 0) + 1
+        return depth
+
+    def _record(self, priority: int, wait_time: float):
+        self.granted[priority] = self.granted.get(priority, 0) + 1
+        self.wait_time_total[priority] = self.wait_time_total.get(priority, 0.0) + wait_time
+        if wait_time > self.wait_time_max.get(priority, 0.0):
+            self.wait_time_max[priority] = wait_time
+
+    async def acquire(self, priority: int = PRIORITY_DEFAULT):
+        """Ждёт разрешения на один запрос к API"""
+        # Быстрый путь: очереди нет и бюджет есть
+        if not self._queue and self.bucket.time_until_available() == 0:
+            self.bucket.consume()
+            self._record(priority, 0.0)
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (priority, self._seq, time.monotonic(), future))
+        self.queued[priority] = self.queued.get(priority, 0) + 1
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        try:
+            while self._queue:
+                delay = self.bucket.time_until_available()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                priority, seq, enqueued_at, future = heapq.heappop(self._queue)
+                if future.done():
+                    # Запрос отменили, пока он ждал в очереди
+                    continue
+                self.bucket.consume()
+                self._record(priority, time.monotonic() - enqueued_at)
+                future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth(),
+            'granted': dict(self.granted),
+            'queued': dict(self.queued),
+            'avg_wait_ms': {
+                priority: round(self.wait_time_total[priority] / count * 1000, 2)
+                for priority, count in self.granted.items()
+            },
+            'max_wait_ms': {
+                priority: round(wait_time * 1000, 2)
+                for priority, wait_time in self.wait_time_max.items()
+            }
+        }
+
+VK_API_URL = getattr(Config, 'vk_api_url', None)
+VK_REQUESTS_PER_SECOND = getattr(Config, 'vk_requests_per_second', 20)
+outbound_scheduler = OutboundScheduler(
+    VK_REQUESTS_PER_SECOND,
+    getattr(Config, 'vk_requests_burst', max(1, VK_REQUESTS_PER_SECOND // 4))
+)
+
+# Методы, вызовы которых можно склеивать в один execute
+BATCHABLE_METHODS = {'messages.send', 'messages.removeChatUser'}
+
+class ExecuteBatcher:
+    """
+    Собирает вызовы API, сделанные в течение короткого окна, и отправляет их
+    одним запросом execute (до 25 вызовов). Каждый вызывающий получает свой результат.
+    Если пакет целиком не удался, вызовы выполняются по одному
+    """
+
+    MAX_CALLS = 25
+
+    def __init__(self, api: "ScheduledAPI", window_ms: int):
+        self.api = api
+        self.window = window_ms / 1000
+        self._pending = []  # (method, data, future)
+        self._flush_handle = None
+        self.batches = 0
+        self.batched_calls = 0
+        self.single_calls = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def submit(self, method: str, data: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((method, data, future))
+        if len(self._pending) >= self.MAX_CALLS:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        calls, self._pending = self._pending, []
+        if calls:
+            asyncio.ensure_future(self._flush(calls))
+
+    async def _flush(self, calls: list):
+        if len(calls) == 1:
+            # Склеивать не с чем - обычный запрос
+            self.single_calls += 1
+            await self._call_one(*calls[0])
+            return
+        
+        try:
+            results, errors = await self._execute(calls)
+        except Exception as e:
+            logger.warning(f"Пакетный запрос execute из {len(calls)} вызовов не удался ({e}), выполняем по одному")
+            self.fallbacks += 1
+            await asyncio.gather(*(self._call_one(*call) for call in calls))
+            return
+        
+        self.batches += 1
+        self.batched_calls += len(calls)
+        # Неудачные вызовы внутри execute возвращают false, а ошибки идут по порядку в execute_errors
+        errors = iter(errors)
+        for (method, data, future), result in zip(calls, results):
+            if future.done():
+                continue
+            if result is False:
+                error = next(errors, {})
+                future.set_exception(VKAPIError[error.get('error_code', 0)](
+                    error_msg=error.get('error_msg', f"Ошибка {method} внутри execute")
+                ))
+            else:
+                future.set_result({'response': result})
+
+    async def _execute(self, calls: list):
+        code_calls = []
+        for method, data, future in calls:
+            params = await self.api.validate_request(dict(data))
+            code_calls.append(f"API.{method}({json.dumps(params, ensure_ascii=False)})")
+        code = "return [" + ",".join(code_calls) + "];"
+        priority = min(METHOD_PRIORITIES.get(method, PRIORITY_DEFAULT) for method, data, future in calls)
+        
+        response = await self.api.request_now('execute', {'code': code}, priority=priority)
+        results = response.get('response') if response else None
+        if not isinstance(results, list) or len(results) != len(calls):
+            raise ValueError(f"неожиданный ответ execute: {results!r}")
+        return results, response.get('execute_errors', [])
+
+    async def _call_one(self, method: str, data: dict, future: asyncio.Future):
+        try:
+            result = await self.api.request_now(method, data, priority=METHOD_PRIORITIES.get(method, PRIORITY_DEFAULT))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'batched_calls': self.batched_calls,
+            'single_calls': self.single_calls,
+            'fallbacks': self.fallbacks
+        }
+
+VK_EXECUTE_WINDOW_MS = getattr(Config, 'vk_execute_window_ms', 15)
+
+class ScheduledAPI(API):
+    """API, все запросы которого проходят через outbound_scheduler"""
+
+    MAX_RATE_LIMIT_RETRIES = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batcher = ExecuteBatcher(self, VK_EXECUTE_WINDOW_MS)
+
+    async def request(self, method: str, data: dict, version: str = None) -> dict:
+        if version is None and method in BATCHABLE_METHODS and self.batcher.enabled:
+            return await self.batcher.submit(method, data)
+        return await self.request_now(method, data, version, METHOD_PRIORITIES.get(method, PRIORITY_DEFAULT))
+
+    async def request_now(self, method: str, data: dict, version: str = None,
+                          priority: int = PRIORITY_DEFAULT) -> dict:
+        """Выполняет запрос сразу, минуя пакетирование"""
+        attempt = 0
+        while True:
+            await outbound_scheduler.acquire(priority)
+            started = time.perf_counter()
+            try:
+                return await super().request(method, data, version)
+            except VKAPIError as e:
+                metrics.inc('vkbot_errors_total', source='vk_api')
+                # Лимит всё-таки превышен: ставим запрос в очередь повторно, а не роняем
+                if e.code != TOO_MANY_REQUESTS_ERROR_CODE or attempt >= self.MAX_RATE_LIMIT_RETRIES:
+                    raise
+                attempt += 1
+                outbound_scheduler.bucket.drain()
+                logger.warning(f"Превышен лимит запросов VK API на {method}, повтор {attempt}")
+            finally:
+                metrics.observe('vkbot_vk_request_seconds', time.perf_counter() - started, method=method)
+
+class ChatState:
+    """Настройки активированной беседы, которые держатся в памяти процесса"""
+    __slots__ = ('chat_id', 'peer_id', 'owner_id', 'silence', 'welcome_message', 'leave_kick')
+
+    def __init__(self, chat_id, peer_id, owner_id, silence=0, welcome_message=DEFAULT_WELCOME_MESSAGE, leave_kick=1):
+        self.chat_id = chat_id
+        self.peer_id = peer_id
+        self.owner_id = owner_id
+        self.silence = silence
+        self.welcome_message = welcome_message
+        self.leave_kick = leave_kick
+
+# Кэш состояния бесед: chat_id -> ChatState.
+# Загружается один раз при старте, команды обновляют его вместе с таблицей chats
+chat_states = {}
+
+class PermissionCache:
+    """Ограниченный LRU-кэш уровней прав: (user_id, chat_id) -> level"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Меняется при каждой инвалидации
+        self._levels = OrderedDict()
+
+    def get(self, user_id: int, chat_id: int):
+        """Возвращает уровень из кэша или None, если его там нет"""
+        key = (user_id, chat_id)
+        level = self._levels.get(key)
+        if level is None:
+            self.misses += 1
+            return None
+        self._levels.move_to_end(key)
+        self.hits += 1
+        return level
+
+    def put(self, user_id: int, chat_id: int, level: int, generation: int = None):
+        """
+        Сохраняет уровень в кэш
+        :param generation: Поколение кэша на момент чтения из БД. Если с тех пор была
+                           инвалидация, значение могло устареть и не сохраняется
+        """
+        if generation is not None and generation != self.generation:
+            return
+        key = (user_id, chat_id)
+        self._levels[key] = level
+        self._levels.move_to_end(key)
+        while len(self._levels) > self.max_size:
+            self._levels.popitem(last=False)
+
+    def invalidate(self, user_id: int, chat_id: int):
+        self.generation += 1
+        self._levels.pop((user_id, chat_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._levels),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+permission_cache = PermissionCache(getattr(Config, 'permission_cache_size', 10000))
+
+class NickCache:
+    """
+    Ники по беседам: chat_id -> {user_id: nick}. Беседа загружается целиком одним
+    запросом при первом обращении, в памяти держатся max_chats последних бесед
+    """
+
+    def __init__(self, max_chats: int = 1000):
+        self.max_chats = max_chats
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Меняется при каждой инвалидации
+        self._chats = OrderedDict()
+
+    def get_chat(self, chat_id: int):
+        """Возвращает ники беседы из кэша или None, если беседа не загружена"""
+        nicks = self._chats.get(chat_id)
+        if nicks is None:
+            self.misses += 1
+            return None
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        return nicks
+
+    def put_chat(self, chat_id: int, nicks: dict, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._chats[chat_id] = nicks
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        self.generation += 1
+        self._chats.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'chats': len(self._chats),
+            'max_chats': self.max_chats,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+nick_cache = NickCache(getattr(Config, 'nick_cache_chats', 1000))
+
+class ExpiringRegistry:
+    """
+    Записи со сроком окончания в памяти: словарь пользователей для каждой беседы
+    и min-куча сроков окончания, которую разбирает фоновая задача.
+    end_time = None - бессрочная запись, в кучу она не попадает
+    """
+
+    def __init__(self):
+        self._entries = {}  # chat_id -> {user_id: end_time}
+        self._expiry_heap = []  # (end_time, chat_id, user_id)
+        self._wakeup = None  # Создаётся в цикле событий фоновой задачи
+
+    def __len__(self):
+        return sum(len(users) for users in self._entries.values())
+
+    def add(self, chat_id: int, user_id: int, end_time: int = None):
+        self._entries.setdefault(chat_id, {})[user_id] = end_time
+        if end_time is None:
+            return
+        heapq.heappush(self._expiry_heap, (end_time, chat_id, user_id))
+        # Новый срок может оказаться раньше того, которого ждёт фоновая задача
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def remove(self, chat_id: int, user_id: int) -> bool:
+        """Удаляет запись, возвращает True если она была. Запись в куче удалится лениво"""
+        users = self._entries.get(chat_id)
+        if not users or user_id not in users:
+            return False
+        del users[user_id]
+        if not users:
+            del self._entries[chat_id]
+        return True
+
+    def is_active(self, chat_id: int, user_id: int, now: float = None) -> bool:
+        users = self._entries.get(chat_id)
+        if not users or user_id not in users:
+            return False
+        end_time = users[user_id]
+        return end_time is None or end_time > (now if now is not None else time.time())
+
+    def pop_expired(self, now: float) -> list:
+        """Удаляет из памяти истекшие записи и возвращает их как (chat_id, user_id, end_time)"""
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            end_time, chat_id, user_id = heapq.heappop(self._expiry_heap)
+            users = self._entries.get(chat_id)
+            # Запись могла устареть: её сняли или продлили
+            if users and users.get(user_id) == end_time:
+                del users[user_id]
+                if not users:
+                    del self._entries[chat_id]
+                expired.append((chat_id, user_id, end_time))
+        return expired
+
+    async def run_expiry_worker(self, on_expired, batch_delay: float = 0):
+        """
+        Ждёт ближайшего срока окончания и передаёт истекшие записи в on_expired.
+        batch_delay - сколько ещё подождать после срока, чтобы соседние
+        сроки ушли в on_expired одной пачкой
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._expiry_heap:
+                timeout = max(0.0, self._expiry_heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            
+            if batch_delay and self._expiry_heap and self._expiry_heap[0][0] <= time.time():
+                await asyncio.sleep(batch_delay)
+            expired = self.pop_expired(time.time())
+            if expired:
+                try:
+                    await on_expired(expired)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке истекших записей: {e}")
+
+class MuteRegistry(ExpiringRegistry):
+    """Активные муты в памяти"""
+
+    def is_muted(self, chat_id: int, user_id: int, now: float = None) -> bool:
+        return self.is_active(chat_id, user_id, now)
+
+class BanIndex(ExpiringRegistry):
+    """
+    Активные баны в памяти. Проверка входа в беседу обращается к таблице bans
+    только за подробностями бана для тех, кто действительно забанен
+    """
+
+    def is_banned(self, chat_id: int, user_id: int, now: float = None) -> bool:
+        return self.is_active(chat_id, user_id, now)
+
+    def banned_among(self, chat_id: int, user_ids, now: float = None) -> list:
+        """Забаненные из user_ids в порядке user_ids"""
+        if chat_id not in self._entries:
+            return []
+        now = now if now is not None else time.time()
+        return [user_id for user_id in user_ids if self.is_active(chat_id, user_id, now)]
+
+mute_registry = MuteRegistry()
+ban_index = BanIndex()
+
+class MessageWriteBehind:
+    """
+    Буфер записи отслеживаемых сообщений: вставки копятся в памяти и пишутся
+    одним пакетом (storage.add_messages) раз в flush_interval секунд или по batch_size строк
+    """
+
+    def __init__(self, flush_interval: float = 0.5, batch_size: int = 200):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._flush_lock = None
+        self._batch_ready = None
+        # Метрики
+        self.max_depth = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_duration = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def add(self, chat_id: int, user_id: int, cmid: int):
+        self._pending.append((chat_id, user_id, cmid))
+        if len(self._pending) > self.max_depth:
+            self.max_depth = len(self._pending)
+        if len(self._pending) >= self.batch_size and self._batch_ready is not None:
+            self._batch_ready.set()
+
+    def drain(self) -> list:
+        """Забирает все ожидающие строки (для синхронной записи при остановке)"""
+        rows, self._pending = self._pending, []
+        return rows
+
+    async def flush(self):
+        """Записывает накопленные строки. После возврата все добавленные ранее строки есть в БД"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            rows = self.drain()
+            if not rows:
+                return
+            started = time.perf_counter()
+            try:
+                await storage.add_messages(rows)
+            except Exception as e:
+                # Возвращаем строки в начало очереди, попробуем при следующем сбросе
+                self._pending[:0] = rows
+                self.failed_flushes += 1
+                logger.error(f"Ошибка при записи {len(rows)} сообщений: {e}")
+                return
+            self.last_flush_duration = time.perf_counter() - started
+            self.flushed_rows += len(rows)
+            self.flushes += 1
+
+    async def run(self):
+        """Фоновая задача периодического сброса буфера"""
+        self._batch_ready = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'flushed_rows': self.flushed_rows,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': round(self.last_flush_duration * 1000, 2)
+        }
+
+message_buffer = MessageWriteBehind(
+    getattr(Config, 'messages_flush_interval_ms', 500) / 1000,
+    getattr(Config, 'messages_flush_batch_size', 200)
+)
+
+class MessageRetention:
+    """
+    Фоновая очистка таблицы messages: VK позволяет удалить сообщение для всех
+    только в течение ограниченного времени, более старые cmid бесполезны.
+    Строки удаляются небольшими пачками с паузами, чтобы не держать блокировку записи
+    """
+
+    def __init__(self, max_age: float, interval: float, batch_size: int = 500,
+                 batch_pause: float = 0.05, vacuum_pages: int = 256):
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        # Метрики
+        self.runs = 0
+        self.deleted_rows = 0
+        self.reclaimed_bytes = 0
+        self.last_run_duration = 0.0
+
+    async def run_once(self) -> tuple:
+        """Один проход очистки, возвращает (удалено строк, освобождено байт)"""
+        started = time.perf_counter()
+        # timestamp в таблице заполняется CURRENT_TIMESTAMP, то есть в UTC
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.max_age)).strftime("%Y-%m-%d %H:%M:%S")
+        
+        deleted = 0
+        while True:
+            batch_deleted = await storage.delete_messages_before(cutoff, self.batch_size)
+            deleted += batch_deleted
+            if batch_deleted < self.batch_size:
+                break
+            # Пауза между пачками пропускает вперёд записи из обработчиков
+            await asyncio.sleep(self.batch_pause)
+        
+        reclaimed = 0
+        while True:
+            reclaimed_now, free_pages = await storage.reclaim_space(self.vacuum_pages)
+            reclaimed += reclaimed_now
+            if free_pages == 0 or reclaimed_now == 0:
+                break
+            await asyncio.sleep(self.batch_pause)
+        
+        self.runs += 1
+        self.deleted_rows += deleted
+        self.reclaimed_bytes += reclaimed
+        self.last_run_duration = time.perf_counter() - started
+        if deleted or reclaimed:
+            logger.info(f"Очистка сообщений: удалено строк {deleted}, освобождено {reclaimed} байт")
+        return deleted, reclaimed
+
+    async def run(self):
+        """Фоновая задача периодической очистки"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка при очистке старых сообщений: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            'runs': self.runs,
+            'deleted_rows': self.deleted_rows,
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'last_run_ms': round(self.last_run_duration * 1000, 2)
+        }
+
+message_retention = MessageRetention(
+    getattr(Config, 'messages_retention_hours', 24) * 3600,
+    getattr(Config, 'messages_retention_interval_seconds', 600),
+    getattr(Config, 'messages_retention_batch_size', 500)
+)
+
+# Система регистрации команд
+commands = {}
+
+class ChatDispatcher:
+    """
+    Обработка событий Long Poll: разные беседы обрабатываются параллельно,
+    а события одной беседы - строго по очереди (бан не обгонит следующее сообщение,
+    /mute - следующее сообщение замученного). У каждого peer_id своя очередь и задача,
+    которая завершается после idle_timeout без событий. Одновременно обрабатывается
+    не больше max_concurrency событий
+    """
+
+    def __init__(self, max_concurrency: int = 100, idle_timeout: float = 60):
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self._queues = {}  # peer_id -> asyncio.Queue
+        self._tasks = set()
+        self._semaphore = None
+        self.processed = 0
+        self.max_queue_depth = 0
+
+    def submit(self, event: dict, api: API = None):
+        """Ставит событие в очередь его беседы"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        peer_id = event_peer_id(event)
+        chat_queue = self._queues.get(peer_id)
+        if chat_queue is None:
+            chat_queue = self._queues[peer_id] = asyncio.Queue()
+            task = asyncio.ensure_future(self._worker(peer_id, chat_queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._worker_done)
+        chat_queue.put_nowait((event, api))
+        if chat_queue.qsize() > self.max_queue_depth:
+            self.max_queue_depth = chat_queue.qsize()
+
+    async def _worker(self, peer_id: int, chat_queue: asyncio.Queue):
+        while True:
+            try:
+                event, api = await asyncio.wait_for(chat_queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # Между таймаутом и этой проверкой новых событий прийти не может: мы в том же потоке
+                if chat_queue.empty():
+                    del self._queues[peer_id]
+                    return
+                continue
+            
+            try:
+                async with self._semaphore:
+                    await bot.process_event(event, api or bot.api)
+            except Exception as e:
+                logger.error("Ошибка при обработке события беседы %s: %s", peer_id, e)
+            finally:
+                self.processed += 1
+                chat_queue.task_done()
+
+    def _worker_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Очередь беседы остановилась с ошибкой: %s", task.exception())
+
+    async def join(self):
+        """Дожидается обработки всех уже поставленных событий"""
+        await asyncio.gather(*(chat_queue.join() for chat_queue in list(self._queues.values())))
+
+    async def close(self):
+        """Дорабатывает поставленные события и останавливает задачи бесед"""
+        await self.join()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        self._queues.clear()
+
+    def stats(self) -> dict:
+        return {
+            'chats': len(self._queues),
+            'queued': sum(chat_queue.qsize() for chat_queue in self._queues.values()),
+            'max_queue_depth': self.max_queue_depth,
+            'processed': self.processed
+        }
+
+chat_dispatcher = ChatDispatcher(
+    getattr(Config, 'dispatch_max_concurrency', 100),
+    getattr(Config, 'dispatch_idle_seconds', 60)
+)
+
+class OrderedBot(Bot):
+    """Bot, который отдаёт события Long Poll в chat_dispatcher вместо задачи на каждое событие"""
+
+    async def run_polling(self, custom_polling=None):
+        polling = custom_polling or self.polling
+        logger.info("Запуск Long Poll с упорядоченной обработкой по беседам")
+        async for event in polling.listen():
+            for update in event.get('updates', []):
+                chat_dispatcher.submit(update, polling.api)
+
+METRICS_HOST = getattr(Config, 'metrics_host', '127.0.0.1')
+METRICS_PORT = getattr(Config, 'metrics_port', None)
+
+async def metrics_handler(request):
+    depth = outbound_scheduler.depth()
+    for priority in (PRIORITY_ENFORCEMENT, PRIORITY_DEFAULT, PRIORITY_REPLY):
+        metrics.set('vkbot_vk_queue_depth', depth.get(priority, 0), priority=priority)
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    """Поднимает HTTP-эндпоинт /metrics в формате Prometheus, если задан metrics_port"""
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+def register_command(command_names, permission_level=PERMISSION_LEVELS['ZERO']):
+    def decorator(func):
+        # Метрики пишутся под основным именем команды, а не под каждым синонимом
+        command_label = command_names[0].lower()
+        
+        @wraps(func)
+        async def timed(message, args):
+            started = time.perf_counter()
+            try:
+                return await func(message, args)
+            except Exception:
+                metrics.inc('vkbot_errors_total', source='command')
+                raise
+            finally:
+                metrics.observe('vkbot_command_seconds', time.perf_counter() - started, command=command_label)
+        
+        for cmd in command_names:
+            commands[cmd.lower()] = (timed, permission_level)  # Приводим к нижнему регистру
+        return timed
+    return decorator
+
+# Инициализация бота и базы данных
+def initialize_bot():
+    global bot, api
+    
+    try:
+        logger.info("Попытка инициализации бота с токеном: %s", vk_token[:10] + "..." if vk_token else "None")
+        api = ScheduledAPI(vk_token)
+        if VK_API_URL:
+            # Например, локальный benchmarks/fake_vk_server.py для нагрузочных тестов
+            api.API_URL = VK_API_URL
+            logger.info("VK API: %s", VK_API_URL)
+        bot = OrderedBot(api=api)
+        logger.info("Бот и API успешно инициализированы")
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации бота: {e}")
+        exit(1)
+
+    try:
+        storage.open()
+    except Exception as e:
+        logger.error(f"Ошибка при подключении к базе данных: {e}")
+        exit(1)
+    
+    load_chat_states()
+    load_mutes()
+    load_bans()
+
+def configure_connection(connection, read_only: bool = False):
+    """Применяет к соединению настройки производительности SQLite"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+        # Отрицательное значение cache_size задаётся в килобайтах
+        cursor.execute(f"PRAGMA cache_size = {-int(DB_CACHE_SIZE_KB)}")
+        cursor.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = 1")
+        else:
+            # WAL: читатели не блокируют запись, а commit не переписывает журнал отката.
+            # Режим журнала хранится в файле базы, поэтому его задаёт только основное соединение
+            cursor.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+            journal_mode = cursor.fetchone()[0]
+            if journal_mode.lower() != str(DB_JOURNAL_MODE).lower():
+                logger.warning(f"Не удалось включить journal_mode={DB_JOURNAL_MODE}, используется {journal_mode}")
+            cursor.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    finally:
+        cursor.close()
+
+def init_db():
+    """Инициализация таблиц базы данных"""
+    try:
+        cursor = database.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS warns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                reason TEXT,
+                warned_by INTEGER NOT NULL,
+                warned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                active INTEGER DEFAULT 1  -- 1 - активное предупреждение, 0 - снятое
+            )
+        ''')
+# В функции init_db() измените создание таблицы chats:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                end_time INTEGER,  -- NULL означает бессрочный бан
+                reason TEXT,
+                banned_by INTEGER NOT NULL,
+                banned_at INTEGER DEFAULT (strftime('%s', 'now')),  -- UNIX timestamp
+                UNIQUE(chat_id, user_id)
+            )
+        ''')
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                peer_id INTEGER,
+                owner_id INTEGER,
+                silence INTEGER DEFAULT 0,
+                welcome_message TEXT DEFAULT 'Добро пожаловать в беседу!',
+                leave_kick INTEGER DEFAULT 1,  -- Новое поле: 1 - включено, 0 - выключено
+                settings TEXT DEFAULT '{}',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS mutes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                end_time INTEGER NOT NULL,
+                reason TEXT,
+                UNIQUE(chat_id, user_id)
+            )
+        ''')
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER,
+                chat_id INTEGER,
+                permission_level INTEGER DEFAULT 0,
+                nick TEXT,
+                PRIMARY KEY (user_id, chat_id)
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS devs (
+                user_id INTEGER,
+                chat_id INTEGER,
+                previous_level INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, chat_id)
+            )
+        """)
+        
+        # Новая таблица для сообщений
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id INTEGER,
+                user_id INTEGER,
+                cmid INTEGER,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chat_id, cmid)
+            )
+        """)
+        
+        database.commit()
+        
+        apply_migrations(cursor)
+        cursor.close()
+        logger.info("Таблицы базы данных инициализированы")
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации базы данных: {e}")
+
+def vacuum_for_auto_vacuum(cursor):
+    """
+    Выполняет VACUUM, без которого не применяется новый PRAGMA auto_vacuum.
+    VACUUM переписывает весь файл под эксклюзивной блокировкой, поэтому на базе
+    больше DB_MIGRATION_VACUUM_MAX_MB он пропускается: его нужно выполнить вручную
+    при остановленном боте. До этого старые сообщения удаляются, но файл не уменьшается
+    """
+    cursor.execute("PRAGMA page_size")
+    page_size = cursor.fetchone()[0]
+    cursor.execute("PRAGMA page_count")
+    size_mb = cursor.fetchone()[0] * page_size / (1024 * 1024)
+    
+    if size_mb > DB_MIGRATION_VACUUM_MAX_MB:
+        logger.warning(
+            f"VACUUM пропущен: база {size_mb:.1f} МБ больше db_migration_vacuum_max_mb = {DB_MIGRATION_VACUUM_MAX_MB}. "
+            f"Чтобы файл уменьшался после очистки сообщений, остановите бота и выполните: "
+            f"sqlite3 {DATABASE_PATH} \"PRAGMA auto_vacuum = INCREMENTAL; VACUUM;\""
+        )
+        return
+    
+    logger.info(f"VACUUM базы ({size_mb:.1f} МБ) для auto_vacuum = INCREMENTAL, до его завершения бот не отвечает")
+    started = time.monotonic()
+    cursor.execute("VACUUM")
+    cursor.execute("PRAGMA page_count")
+    vacuumed_mb = cursor.fetchone()[0] * page_size / (1024 * 1024)
+    logger.info(f"VACUUM завершён за {time.monotonic() - started:.1f} с, размер базы {size_mb:.1f} -> {vacuumed_mb:.1f} МБ")
+
+# Миграции схемы. Миграция с индексом i переводит базу на версию i + 1,
+# текущая версия хранится в PRAGMA user_version. Новые миграции добавляются в конец.
+# Шаг миграции - SQL-запрос или функция, которая получает курсор
+MIGRATIONS = [
+    # 1: индексы для частых запросов по warns, messages и mutes
+    [
+        # COUNT(*) активных варнов, /unwarn и /warnhistory
+        "CREATE INDEX IF NOT EXISTS idx_warns_chat_user_active ON warns (chat_id, user_id, active, warned_at)",
+        # /warnlist: активные варны беседы по времени
+        "CREATE INDEX IF NOT EXISTS idx_warns_chat_active_time ON warns (chat_id, active, warned_at)",
+        # /clear: все cmid пользователя в беседе
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_user ON messages (chat_id, user_id, cmid)",
+        # Загрузка и очистка истекших мутов
+        "CREATE INDEX IF NOT EXISTS idx_mutes_end_time ON mutes (end_time)",
+    ],
+    # 2: очистка старых сообщений. auto_vacuum меняется только через VACUUM,
+    # на большой базе его нужно выполнить вручную (см. vacuum_for_auto_vacuum)
+    [
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        vacuum_for_auto_vacuum,
+        "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)",
+    ],
+    # 3: очистка истекших банов при запуске
+    [
+        "CREATE INDEX IF NOT EXISTS idx_bans_end_time ON bans (end_time)",
+    ],
+]
+
+def apply_migrations(cursor):
+    """Применяет к базе все миграции новее её PRAGMA user_version"""
+    cursor.execute("PRAGMA user_version")
+    current_version = cursor.fetchone()[0]
+    
+    for version in range(current_version, len(MIGRATIONS)):
+        try:
+            for statement in MIGRATIONS[version]:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            # PRAGMA не поддерживает параметры, version - число из кода
+            cursor.execute(f"PRAGMA user_version = {version + 1}")
+            database.commit()
+            logger.info(f"Применена миграция базы данных до версии {version + 1}")
+        except Exception:
+            database.rollback()
+            raise
+
+# Частые запросы и индексы, по которым они должны выполняться
+# (вместо полного прохода таблицы или поиска по более короткому индексу).
+# Планы проверяет tests/test_query_plans.py
+HOT_QUERIES = [
+    ("SELECT COUNT(*) FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1",
+     'idx_warns_chat_user_active'),
+    ("SELECT id FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1 ORDER BY warned_at DESC LIMIT 1",
+     'idx_warns_chat_user_active'),
+    ("SELECT reason, warned_by, warned_at, active FROM warns WHERE chat_id = ? AND user_id = ? ORDER BY warned_at DESC LIMIT 10",
+     'idx_warns_chat_user_active'),
+    ("""SELECT w.user_id, w.reason, w.warned_by, w.warned_at, u.nick
+        FROM warns w
+        LEFT JOIN users u ON w.user_id = u.user_id AND w.chat_id = u.chat_id
+        WHERE w.chat_id = ? AND w.active = 1
+        ORDER BY w.warned_at DESC""",
+     'idx_warns_chat_active_time'),
+    ("SELECT cmid, timestamp FROM messages WHERE chat_id = ? AND user_id = ?",
+     'idx_messages_chat_user'),
+    ("SELECT * FROM devs WHERE user_id = ? LIMIT 1",
+     'sqlite_autoindex_devs_1'),
+    ("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?",
+     'sqlite_autoindex_users_1'),
+    ("""SELECT user_id, end_time, reason, banned_by, banned_at
+        FROM bans
+        WHERE chat_id = ? AND user_id IN (SELECT value FROM json_each(?)) AND (end_time IS NULL OR end_time > ?)""",
+     'sqlite_autoindex_bans_1'),
+    ("DELETE FROM bans WHERE end_time <= ?",
+     'idx_bans_end_time'),
+    ("DELETE FROM mutes WHERE end_time <= ?",
+     'idx_mutes_end_time'),
+]
+
+def find_unindexed_queries(connection) -> list:
+    """
+    Проверяет планы HOT_QUERIES через EXPLAIN QUERY PLAN
+    :return: Список (запрос, план) для запросов с полным проходом таблицы
+             или без ожидаемого индекса
+    """
+    problems = []
+    cursor = connection.cursor()
+    try:
+        for query, expected_index in HOT_QUERIES:
+            params = (None,) * query.count('?')
+            cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            # Проход по json_each - это проход по переданному списку, а не по таблице
+            full_scan = any(detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail for detail in plan)
+            if full_scan or not any(expected_index in detail for detail in plan):
+                problems.append((' '.join(query.split()), '; '.join(plan)))
+    finally:
+        cursor.close()
+    return problems
+
+
+# Асинхронный доступ к базе данных
+# Все запросы выполняются в потоке db_executor, каждый со своим курсором,
+# поэтому корутины не блокируют event loop и не читают чужие результаты.
+
+def _run_fetchone(query, params):
+    cursor = database.cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+def _run_fetchall(query, params):
+    cursor = database.cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+def _run_execute(query, params):
+    cursor = database.cursor()
+    try:
+        cursor.execute(query, params)
+        database.commit()
+        return cursor.rowcount
+    except Exception:
+        database.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def _run_executemany(query, seq_of_params):
+    cursor = database.cursor()
+    try:
+        cursor.executemany(query, seq_of_params)
+        database.commit()
+        return cursor.rowcount
+    except Exception:
+        database.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def _run_transaction(func, args):
+    cursor = database.cursor()
+    try:
+        result = func(cursor, *args)
+        database.commit()
+        return result
+    except Exception:
+        database.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def _get_read_connection():
+    """Read-only соединение текущего потока пула чтения"""
+    connection = getattr(_db_read_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True, check_same_thread=False)
+        configure_connection(connection, read_only=True)
+        _db_read_local.connection = connection
+        _db_read_connections.append(connection)
+    return connection
+
+def _run_read_fetchall(query, params):
+    cursor = _get_read_connection().cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+_query_labels = {}
+
+def _query_label(query: str) -> str:
+    """Текст запроса без лишних пробелов - метка для метрик"""
+    label = _query_labels.get(query)
+    if label is None:
+        label = _query_labels[query] = ' '.join(query.split())
+    return label
+
+async def _timed_db_call(executor, label: str, func, *args):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor, partial(func, *args))
+    finally:
+        metrics.observe('vkbot_db_query_seconds', time.perf_counter() - started, query=label)
+
+async def db_call(func, *args):
+    """Выполняет синхронную функцию работы с БД в потоке базы данных"""
+    return await _timed_db_call(db_executor, func.__name__, func, *args)
+
+async def db_fetchone(query: str, params: tuple = ()):
+    """SELECT, возвращающий одну строку"""
+    return await _timed_db_call(db_executor, _query_label(query), _run_fetchone, query, params)
+
+async def db_fetchall(query: str, params: tuple = ()) -> list:
+    """SELECT, возвращающий все строки"""
+    return await _timed_db_call(db_executor, _query_label(query), _run_fetchall, query, params)
+
+async def db_read_fetchall(query: str, params: tuple = ()) -> list:
+    """
+    SELECT через пул read-only соединений: тяжёлые чтения для списков
+    не стоят в очереди за записями модерации
+    """
+    if db_read_executor is None:
+        return await db_fetchall(query, params)
+    return await _timed_db_call(db_read_executor, _query_label(query), _run_read_fetchall, query, params)
+
+async def db_execute(query: str, params: tuple = ()) -> int:
+    """Изменяющий запрос с commit, возвращает количество затронутых строк"""
+    return await _timed_db_call(db_executor, _query_label(query), _run_execute, query, params)
+
+async def db_executemany(query: str, seq_of_params) -> int:
+    """Пакетный изменяющий запрос в одной транзакции"""
+    return await _timed_db_call(db_executor, _query_label(query), _run_executemany, query, list(seq_of_params))
+
+async def db_transaction(func, *args):
+    """
+    Выполняет func(cursor, *args) в потоке БД как одну транзакцию
+    :return: Результат func
+    """
+    return await _timed_db_call(db_executor, func.__name__, _run_transaction, func, args)
+
+# Хранилище данных
+# Обработчики работают с данными только через storage. Весь SQL собран в SQLiteStorage,
+# MemoryStorage держит те же данные в словарях процесса (бенчмарки, проверки без диска).
+
+class Storage(abc.ABC):
+    """
+    Интерфейс хранилища: беседы, пользователи и права, ники, варны, баны, муты,
+    разработчики и отслеживаемые сообщения. Бэкенд, не реализовавший какой-либо
+    метод, не создастся (TypeError в create_storage). open/close и load_* синхронные:
+    они вызываются до запуска цикла событий и после его остановки
+    """
+
+    # Жизненный цикл
+
+    @abc.abstractmethod
+    def open(self):
+        """Подключает хранилище и готовит схему"""
+
+    @abc.abstractmethod
+    def close(self, pending_messages: list = ()):
+        """Дописывает pending_messages из буфера и закрывает хранилище"""
+
+    # Загрузка состояния при запуске
+
+    @abc.abstractmethod
+    def load_chats(self) -> list:
+        """[(chat_id, peer_id, owner_id, silence, welcome_message, leave_kick)]"""
+
+    @abc.abstractmethod
+    def load_active_mutes(self, now: int) -> list:
+        """Удаляет истекшие муты, возвращает активные [(chat_id, user_id, end_time)]"""
+
+    @abc.abstractmethod
+    def load_active_bans(self, now: int) -> list:
+        """Удаляет истекшие баны, возвращает активные [(chat_id, user_id, end_time)]"""
+
+    # Беседы
+
+    @abc.abstractmethod
+    async def create_chat(self, chat_id: int, peer_id: int, owner_id: int, owner_nick: str = None):
+        """Активирует беседу и выдаёт создателю уровень THREE"""
+
+    @abc.abstractmethod
+    async def set_silence(self, chat_id: int, silence: int):
+        """Включает или выключает режим тишины"""
+
+    @abc.abstractmethod
+    async def set_welcome_message(self, chat_id: int, welcome_message: str):
+        """Меняет приветствие беседы"""
+
+    @abc.abstractmethod
+    async def set_leave_kick(self, chat_id: int, leave_kick: int):
+        """Включает или выключает кик при выходе"""
+
+    # Пользователи и права
+
+    @abc.abstractmethod
+    async def get_permission(self, user_id: int, chat_id: int):
+        """Уровень прав или None, если записи о пользователе нет"""
+
+    @abc.abstractmethod
+    async def set_permission(self, user_id: int, chat_id: int, level: int):
+        """Меняет уровень прав, сохраняя ник; у разработчика запоминает уровень в devs"""
+
+    @abc.abstractmethod
+    async def reset_permission(self, user_id: int, chat_id: int):
+        """Снимает права (уровень ZERO), сохраняя ник"""
+
+    @abc.abstractmethod
+    async def get_staff(self, chat_id: int) -> list:
+        """[(user_id, permission_level, nick)] с правами выше ZERO, по убыванию уровня"""
+
+    # Ники
+
+    @abc.abstractmethod
+    async def get_chat_nicks(self, chat_id: int) -> dict:
+        """{user_id: nick} беседы"""
+
+    @abc.abstractmethod
+    async def set_nick(self, user_id: int, chat_id: int, nick: str):
+        """Устанавливает ник, не меняя права"""
+
+    @abc.abstractmethod
+    async def remove_nick(self, user_id: int, chat_id: int):
+        """Удаляет ник пользователя"""
+
+    # Разработчики
+
+    @abc.abstractmethod
+    async def is_developer(self, user_id: int) -> bool:
+        """Есть ли у пользователя запись в devs хотя бы в одной беседе"""
+
+    @abc.abstractmethod
+    async def get_developer_level(self, user_id: int, chat_id: int):
+        """Сохранённый уровень разработчика в беседе или None"""
+
+    @abc.abstractmethod
+    async def set_developer_level(self, user_id: int, chat_id: int, level: int):
+        """Запоминает уровень разработчика в беседе"""
+
+    @abc.abstractmethod
+    async def remove_developer(self, user_id: int, chat_id: int):
+        """Удаляет запись разработчика в беседе"""
+
+    # Предупреждения
+
+    @abc.abstractmethod
+    async def add_warn(self, chat_id: int, user_id: int, reason: str, warned_by: int) -> int:
+        """Добавляет варн, возвращает количество активных варнов пользователя"""
+
+    @abc.abstractmethod
+    async def remove_last_warn(self, chat_id: int, user_id: int):
+        """Снимает последний активный варн, возвращает оставшееся количество или None, если снимать нечего"""
+
+    @abc.abstractmethod
+    async def clear_warns(self, chat_id: int, user_id: int):
+        """Снимает все активные варны пользователя"""
+
+    @abc.abstractmethod
+    async def get_active_warns(self, chat_id: int) -> list:
+        """[(user_id, reason, warned_by, warned_at, nick)] беседы, новые первыми"""
+
+    @abc.abstractmethod
+    async def get_warn_history(self, chat_id: int, user_id: int, limit: int = 10) -> list:
+        """[(reason, warned_by, warned_at, active)] пользователя, новые первыми"""
+
+    # Баны
+
+    @abc.abstractmethod
+    async def add_ban(self, chat_id: int, user_id: int, end_time, reason: str, banned_by: int, banned_at: int):
+        """Добавляет или заменяет бан. end_time = None - бессрочный"""
+
+    @abc.abstractmethod
+    async def remove_ban(self, chat_id: int, user_id: int) -> bool:
+        """Снимает бан, возвращает True если он был"""
+
+    @abc.abstractmethod
+    async def get_bans(self, chat_id: int, user_ids: list, now: int) -> dict:
+        """Активные баны из user_ids: {user_id: (end_time, reason, banned_by, banned_at)}"""
+
+    @abc.abstractmethod
+    async def delete_expired_bans(self, expired: list):
+        """Удаляет баны [(chat_id, user_id, end_time)], если они не были продлены"""
+
+    # Муты
+
+    @abc.abstractmethod
+    async def add_mute(self, chat_id: int, user_id: int, end_time: int, reason: str):
+        """Добавляет или заменяет мут"""
+
+    @abc.abstractmethod
+    async def remove_mute(self, chat_id: int, user_id: int):
+        """Снимает мут"""
+
+    @abc.abstractmethod
+    async def delete_expired_mutes(self, expired: list):
+        """Удаляет муты [(chat_id, user_id, end_time)], если они не были продлены"""
+
+    # Отслеживаемые сообщения
+
+    @abc.abstractmethod
+    async def add_messages(self, rows: list):
+        """Запоминает сообщения [(chat_id, user_id, cmid)], повторы игнорируются"""
+
+    @abc.abstractmethod
+    async def get_user_messages(self, chat_id: int, user_id: int) -> list:
+        """[(cmid, timestamp)] сообщений пользователя, timestamp - строка UTC"""
+
+    @abc.abstractmethod
+    async def delete_messages(self, chat_id: int, cmids) -> int:
+        """Удаляет сообщения по cmid, возвращает количество"""
+
+    @abc.abstractmethod
+    async def delete_messages_before(self, cutoff: str, limit: int) -> int:
+        """Удаляет до limit сообщений старше cutoff (строка UTC), возвращает количество"""
+
+    @abc.abstractmethod
+    async def reclaim_space(self, pages: int) -> tuple:
+        """Возвращает место после удалений: (освобождено байт, осталось свободных страниц)"""
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite: запись через db_executor, тяжёлые чтения через пул read-only соединений"""
+
+    INSERT_MESSAGES_QUERY = "INSERT OR IGNORE INTO messages (chat_id, user_id, cmid) VALUES (?, ?, ?)"
+
+    def open(self):
+        global database, db_executor, db_read_executor
+        database = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        configure_connection(database)
+        # Один рабочий поток: соединение SQLite не используется конкурентно,
+        # а event loop не блокируется на fsync при commit
+        db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        if DB_READ_POOL_SIZE > 0:
+            db_read_executor = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix="db-read")
+        logger.info("База данных успешно подключена")
+        # Инициализация таблиц
+        init_db()
+
+    def close(self, pending_messages: list = ()):
+        """Дожидается завершения запросов в очереди и закрывает соединение"""
+        if db_executor:
+            # Дописываем сообщения, которые ещё не успел сбросить буфер
+            if pending_messages:
+                db_executor.submit(_run_executemany, self.INSERT_MESSAGES_QUERY, list(pending_messages))
+            db_executor.shutdown(wait=True)
+        if db_read_executor:
+            db_read_executor.shutdown(wait=True)
+            for connection in _db_read_connections:
+                connection.close()
+        if database:
+            database.close()
+
+    def load_chats(self) -> list:
+        cursor = database.cursor()
+        try:
+            cursor.execute("SELECT chat_id, peer_id, owner_id, silence, welcome_message, leave_kick FROM chats")
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _load_active(self, table: str, now: int) -> list:
+        cursor = database.cursor()
+        try:
+            cursor.execute(f"DELETE FROM {table} WHERE end_time <= ?", (now,))
+            cursor.execute(f"SELECT chat_id, user_id, end_time FROM {table}")
+            rows = cursor.fetchall()
+            database.commit()
+            return rows
+        finally:
+            cursor.close()
+
+    def load_active_mutes(self, now: int) -> list:
+        return self._load_active("mutes", now)
+
+    def load_active_bans(self, now: int) -> list:
+        return self._load_active("bans", now)
+
+    # Беседы
+
+    @staticmethod
+    def _create_chat_tx(cursor, chat_id, peer_id, owner_id, nick):
+        cursor.execute("INSERT INTO chats (chat_id, peer_id, owner_id, silence, welcome_message, leave_kick) VALUES (?, ?, ?, 0, ?, 1)",
+                       (chat_id, peer_id, owner_id, DEFAULT_WELCOME_MESSAGE))
+        if nick:
+            cursor.execute("INSERT INTO users (user_id, chat_id, permission_level, nick) VALUES (?, ?, ?, ?)",
+                           (owner_id, chat_id, PERMISSION_LEVELS['THREE'], nick))
+        else:
+            cursor.execute("INSERT INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
+                           (owner_id, chat_id, PERMISSION_LEVELS['THREE']))
+
+    async def create_chat(self, chat_id: int, peer_id: int, owner_id: int, owner_nick: str = None):
+        await db_transaction(self._create_chat_tx, chat_id, peer_id, owner_id, owner_nick)
+
+    async def set_silence(self, chat_id: int, silence: int):
+        await db_execute("UPDATE chats SET silence = ? WHERE chat_id = ?", (silence, chat_id))
+
+    async def set_welcome_message(self, chat_id: int, welcome_message: str):
+        await db_execute("UPDATE chats SET welcome_message = ? WHERE chat_id = ?", (welcome_message, chat_id))
+
+    async def set_leave_kick(self, chat_id: int, leave_kick: int):
+        await db_execute("UPDATE chats SET leave_kick = ? WHERE chat_id = ?", (leave_kick, chat_id))
+
+    # Пользователи и права
+
+    async def get_permission(self, user_id: int, chat_id: int):
+        result = await db_fetchone("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?", 
+                                   (user_id, chat_id))
+        return result[0] if result else None
+
+    @staticmethod
+    def _set_permission_tx(cursor, user_id, chat_id, level):
+        # Проверяем, существует ли запись (ник при этом сохраняется)
+        cursor.execute("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", 
+                       (user_id, chat_id))
+        result = cursor.fetchone()
+        
+        if result:
+            # Если запись существует, обновляем только уровень прав
+            cursor.execute(
+                "UPDATE users SET permission_level = ? WHERE user_id = ? AND chat_id = ?",
+                (level, user_id, chat_id)
+            )
+        else:
+            # Если записи нет, создаем новую
+            cursor.execute(
+                "INSERT INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
+                (user_id, chat_id, level)
+            )
+        
+        # Если пользователь является разработчиком и устанавливается не уровень 4,
+        # обновляем предыдущий уровень в таблице devs
+        if level != PERMISSION_LEVELS['FOUR']:
+            cursor.execute("SELECT 1 FROM devs WHERE user_id = ? LIMIT 1", (user_id,))
+            if cursor.fetchone() is not None:
+                cursor.execute(
+                    """INSERT OR REPLACE INTO devs (user_id, chat_id, previous_level) 
+                       VALUES (?, ?, ?)""",
+                    (user_id, chat_id, level)
+                )
+
+    async def set_permission(self, user_id: int, chat_id: int, level: int):
+        await db_transaction(self._set_permission_tx, user_id, chat_id, level)
+
+    @staticmethod
+    def _reset_permission_tx(cursor, user_id, chat_id):
+        # Сохраняем ник пользователя перед снятием прав
+        cursor.execute("SELECT nick FROM users WHERE user_id = ? AND chat_id = ?", 
+                       (user_id, chat_id))
+        result = cursor.fetchone()
+        current_nick = result[0] if result else None
+        
+        if current_nick is not None:
+            # Если есть ник, обновляем только уровень прав
+            cursor.execute(
+                "UPDATE users SET permission_level = ? WHERE user_id = ? AND chat_id = ?",
+                (PERMISSION_LEVELS['ZERO'], user_id, chat_id)
+            )
+        else:
+            # Если ника нет, используем INSERT OR REPLACE
+            cursor.execute(
+                """INSERT OR REPLACE INTO users (user_id, chat_id, permission_level) 
+                   VALUES (?, ?, ?)""",
+                (user_id, chat_id, PERMISSION_LEVELS['ZERO'])
+            )
+
+    async def reset_permission(self, user_id: int, chat_id: int):
+        await db_transaction(self._reset_permission_tx, user_id, chat_id)
+
+    async def get_staff(self, chat_id: int) -> list:
+        return await db_read_fetchall("""
+            SELECT user_id, permission_level, nick 
+            FROM users 
+            WHERE chat_id = ? AND permission_level > 0 
+            ORDER BY permission_level DESC
+        """, (chat_id,))
+
+    # Ники
+
+    async def get_chat_nicks(self, chat_id: int) -> dict:
+        rows = await db_read_fetchall("SELECT user_id, nick FROM users WHERE chat_id = ? AND nick IS NOT NULL", 
+                                      (chat_id,))
+        return dict(rows)
+
+    @staticmethod
+    def _set_nick_tx(cursor, user_id: int, chat_id: int, nick: str):
+        # Сначала проверяем, существует ли уже запись для этого пользователя
+        cursor.execute("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?", 
+                       (user_id, chat_id))
+        result = cursor.fetchone()
+        
+        if result:
+            # Если запись существует, обновляем только ник
+            cursor.execute(
+                "UPDATE users SET nick = ? WHERE user_id = ? AND chat_id = ?",
+                (nick, user_id, chat_id)
+            )
+        else:
+            # Если записи нет, создаем новую с уровнем прав по умолчанию (0) и ником
+            cursor.execute(
+                "INSERT INTO users (user_id, chat_id, permission_level, nick) VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, 0, nick)
+            )
+
+    async def set_nick(self, user_id: int, chat_id: int, nick: str):
+        await db_transaction(self._set_nick_tx, user_id, chat_id, nick)
+
+    async def remove_nick(self, user_id: int, chat_id: int):
+        await db_execute(
+            "UPDATE users SET nick = NULL WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id)
+        )
+
+    # Разработчики
+
+    async def is_developer(self, user_id: int) -> bool:
+        return await db_fetchone("SELECT * FROM devs WHERE user_id = ? LIMIT 1", (user_id,)) is not None
+
+    async def get_developer_level(self, user_id: int, chat_id: int):
+        result = await db_fetchone("SELECT previous_level FROM devs WHERE user_id = ? AND chat_id = ?", 
+                                   (user_id, chat_id))
+        return result[0] if result else None
+
+    async def set_developer_level(self, user_id: int, chat_id: int, level: int):
+        await db_execute(
+            """INSERT OR REPLACE INTO devs (user_id, chat_id, previous_level) 
+               VALUES (?, ?, ?)""",
+            (user_id, chat_id, level)
+        )
+
+    async def remove_developer(self, user_id: int, chat_id: int):
+        await db_execute("DELETE FROM devs WHERE user_id = ? AND chat_id = ?", 
+                         (user_id, chat_id))
+
+    # Предупреждения
+
+    @staticmethod
+    def _add_warn_tx(cursor, chat_id, user_id, reason, warned_by):
+        cursor.execute(
+            "INSERT INTO warns (chat_id, user_id, reason, warned_by, active) VALUES (?, ?, ?, ?, 1)",
+            (chat_id, user_id, reason, warned_by)
+        )
+        cursor.execute("SELECT COUNT(*) FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1", 
+                       (chat_id, user_id))
+        return cursor.fetchone()[0]
+
+    async def add_warn(self, chat_id: int, user_id: int, reason: str, warned_by: int) -> int:
+        return await db_transaction(self._add_warn_tx, chat_id, user_id, reason, warned_by)
+
+    @staticmethod
+    def _remove_last_warn_tx(cursor, chat_id, user_id):
+        # Получаем последнее активное предупреждение пользователя
+        cursor.execute("""
+            SELECT id FROM warns 
+            WHERE chat_id = ? AND user_id = ? AND active = 1 
+            ORDER BY warned_at DESC LIMIT 1
+        """, (chat_id, user_id))
+        warn_result = cursor.fetchone()
+        if not warn_result:
+            return None
+        
+        # Деактивируем предупреждение
+        cursor.execute("UPDATE warns SET active = 0 WHERE id = ?", (warn_result[0],))
+        
+        cursor.execute("SELECT COUNT(*) FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1", 
+                       (chat_id, user_id))
+        return cursor.fetchone()[0]
+
+    async def remove_last_warn(self, chat_id: int, user_id: int):
+        return await db_transaction(self._remove_last_warn_tx, chat_id, user_id)
+
+    async def clear_warns(self, chat_id: int, user_id: int):
+        await db_execute("UPDATE warns SET active = 0 WHERE chat_id = ? AND user_id = ? AND active = 1",
+                         (chat_id, user_id))
+
+    async def get_active_warns(self, chat_id: int) -> list:
+        return await db_read_fetchall("""
+            SELECT w.user_id, w.reason, w.warned_by, w.warned_at, u.nick
+            FROM warns w
+            LEFT JOIN users u ON w.user_id = u.user_id AND w.chat_id = u.chat_id
+            WHERE w.chat_id = ? AND w.active = 1 
+            ORDER BY w.warned_at DESC
+        """, (chat_id,))
+
+    async def get_warn_history(self, chat_id: int, user_id: int, limit: int = 10) -> list:
+        return await db_read_fetchall("""
+            SELECT reason, warned_by, warned_at, active 
+            FROM warns 
+            WHERE chat_id = ? AND user_id = ? 
+            ORDER BY warned_at DESC 
+            LIMIT ?
+        """, (chat_id, user_id, limit))
+
+    # Баны
+
+    async def add_ban(self, chat_id: int, user_id: int, end_time, reason: str, banned_by: int, banned_at: int):
+        await db_execute(
+            "INSERT OR REPLACE INTO bans (chat_id, user_id, end_time, reason, banned_by, banned_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, user_id, end_time, reason, banned_by, banned_at)
+        )
+
+    async def remove_ban(self, chat_id: int, user_id: int) -> bool:
+        deleted = await db_execute("DELETE FROM bans WHERE chat_id = ? AND user_id = ?", 
+                                   (chat_id, user_id))
+        return deleted > 0
+
+    async def get_bans(self, chat_id: int, user_ids: list, now: int) -> dict:
+        # Список передаётся одним параметром через json_each, поэтому текст запроса
+        # не зависит от размера пачки
+        rows = await db_fetchall("""
+            SELECT user_id, end_time, reason, banned_by, banned_at
+            FROM bans
+            WHERE chat_id = ? AND user_id IN (SELECT value FROM json_each(?)) AND (end_time IS NULL OR end_time > ?)
+        """, (chat_id, json.dumps(list(user_ids)), now))
+        return {row[0]: row[1:] for row in rows}
+
+    async def delete_expired_bans(self, expired: list):
+        await db_executemany(
+            "DELETE FROM bans WHERE chat_id = ? AND user_id = ? AND end_time <= ?",
+            expired
+        )
+
+    # Муты
+
+    async def add_mute(self, chat_id: int, user_id: int, end_time: int, reason: str):
+        await db_execute(
+            "INSERT OR REPLACE INTO mutes (chat_id, user_id, end_time, reason) VALUES (?, ?, ?, ?)",
+            (chat_id, user_id, end_time, reason)
+        )
+
+    async def remove_mute(self, chat_id: int, user_id: int):
+        await db_execute("DELETE FROM mutes WHERE chat_id = ? AND user_id = ?", 
+                         (chat_id, user_id))
+
+    async def delete_expired_mutes(self, expired: list):
+        await db_executemany(
+            "DELETE FROM mutes WHERE chat_id = ? AND user_id = ? AND end_time <= ?",
+            expired
+        )
+
+    # Отслеживаемые сообщения
+
+    async def add_messages(self, rows: list):
+        await db_executemany(self.INSERT_MESSAGES_QUERY, rows)
+
+    async def get_user_messages(self, chat_id: int, user_id: int) -> list:
+        return await db_fetchall("SELECT cmid, timestamp FROM messages WHERE chat_id = ? AND user_id = ?", 
+                                 (chat_id, user_id))
+
+    async def delete_messages(self, chat_id: int, cmids) -> int:
+        return await db_executemany("DELETE FROM messages WHERE chat_id = ? AND cmid = ?", 
+                                    ((chat_id, cmid) for cmid in cmids))
+
+    @staticmethod
+    def _delete_messages_before_tx(cursor, cutoff: str, limit: int) -> int:
+        cursor.execute(
+            "DELETE FROM messages WHERE rowid IN "
+            "(SELECT rowid FROM messages WHERE timestamp < ? LIMIT ?)",
+            (cutoff, limit)
+        )
+        return cursor.rowcount
+
+    async def delete_messages_before(self, cutoff: str, limit: int) -> int:
+        return await db_transaction(self._delete_messages_before_tx, cutoff, limit)
+
+    @staticmethod
+    def _incremental_vacuum_tx(cursor, pages: int) -> tuple:
+        """Освобождает до pages свободных страниц, возвращает (освобождено байт, осталось свободных страниц)"""
+        cursor.execute("PRAGMA page_size")
+        page_size = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count")
+        pages_before = cursor.fetchone()[0]
+        # Модуль sqlite3 делает у прагмы без результата только один шаг,
+        # а каждый шаг освобождает одну страницу, поэтому выполняем её в цикле
+        for _ in range(int(pages)):
+            cursor.execute("PRAGMA freelist_count")
+            if cursor.fetchone()[0] == 0:
+                break
+            cursor.execute("PRAGMA incremental_vacuum")
+        cursor.execute("PRAGMA page_count")
+        pages_after = cursor.fetchone()[0]
+        cursor.execute("PRAGMA freelist_count")
+        return (pages_before - pages_after) * page_size, cursor.fetchone()[0]
+
+    async def reclaim_space(self, pages: int) -> tuple:
+        return await db_transaction(self._incremental_vacuum_tx, pages)
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в словарях процесса. Данные теряются при остановке,
+    режим шардирования с ним не работает: у каждого процесса была бы своя копия
+    """
+
+    def __init__(self):
+        self.chats = {}  # chat_id -> {'peer_id', 'owner_id', 'silence', 'welcome_message', 'leave_kick'}
+        self.users = {}  # chat_id -> {user_id: {'permission_level', 'nick'}}
+        self.devs = {}  # user_id -> {chat_id: previous_level}
+        self.warns = {}  # chat_id -> [{'id', 'user_id', 'reason', 'warned_by', 'warned_at', 'active'}]
+        self.bans = {}  # (chat_id, user_id) -> (end_time, reason, banned_by, banned_at)
+        self.mutes = {}  # (chat_id, user_id) -> (end_time, reason)
+        self.messages = {}  # chat_id -> {cmid: (user_id, timestamp)}
+        self._warn_id = 0
+
+    @staticmethod
+    def _now() -> str:
+        """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+        return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    def _user(self, user_id: int, chat_id: int) -> dict:
+        return self.users.setdefault(chat_id, {}).setdefault(user_id, {'permission_level': 0, 'nick': None})
+
+    def open(self):
+        logger.info("Используется хранилище в памяти, данные не сохраняются между запусками")
+
+    def close(self, pending_messages: list = ()):
+        for chat_id, user_id, cmid in pending_messages:
+            self.messages.setdefault(chat_id, {}).setdefault(cmid, (user_id, self._now()))
+
+    def load_chats(self) -> list:
+        return [(chat_id, chat['peer_id'], chat['owner_id'], chat['silence'], chat['welcome_message'], chat['leave_kick'])
+                for chat_id, chat in self.chats.items()]
+
+    @staticmethod
+    def _load_active(table: dict, now: int) -> list:
+        for key in [key for key, row in table.items() if row[0] is not None and row[0] <= now]:
+            del table[key]
+        return [(chat_id, user_id, row[0]) for (chat_id, user_id), row in table.items()]
+
+    def load_active_mutes(self, now: int) -> list:
+        return self._load_active(self.mutes, now)
+
+    def load_active_bans(self, now: int) -> list:
+        return self._load_active(self.bans, now)
+
+    # Беседы
+
+    async def create_chat(self, chat_id: int, peer_id: int, owner_id: int, owner_nick: str = None):
+        if chat_id in self.chats or owner_id in self.users.get(chat_id, {}):
+            raise ValueError(f"Беседа {chat_id} уже активирована")
+        self.chats[chat_id] = {'peer_id': peer_id, 'owner_id': owner_id, 'silence': 0,
+                               'welcome_message': DEFAULT_WELCOME_MESSAGE, 'leave_kick': 1}
+        self.users.setdefault(chat_id, {})[owner_id] = {'permission_level': PERMISSION_LEVELS['THREE'], 'nick': owner_nick}
+
+    async def set_silence(self, chat_id: int, silence: int):
+        if chat_id in self.chats:
+            self.chats[chat_id]['silence'] = silence
+
+    async def set_welcome_message(self, chat_id: int, welcome_message: str):
+        if chat_id in self.chats:
+            self.chats[chat_id]['welcome_message'] = welcome_message
+
+    async def set_leave_kick(self, chat_id: int, leave_kick: int):
+        if chat_id in self.chats:
+            self.chats[chat_id]['leave_kick'] = leave_kick
+
+    # Пользователи и права
+
+    async def get_permission(self, user_id: int, chat_id: int):
+        user = self.users.get(chat_id, {}).get(user_id)
+        return user['permission_level'] if user else None
+
+    async def set_permission(self, user_id: int, chat_id: int, level: int):
+        self._user(user_id, chat_id)['permission_level'] = level
+        if level != PERMISSION_LEVELS['FOUR'] and user_id in self.devs:
+            self.devs[user_id][chat_id] = level
+
+    async def reset_permission(self, user_id: int, chat_id: int):
+        self._user(user_id, chat_id)['permission_level'] = PERMISSION_LEVELS['ZERO']
+
+    async def get_staff(self, chat_id: int) -> list:
+        staff = [(user_id, user['permission_level'], user['nick'])
+                 for user_id, user in self.users.get(chat_id, {}).items() if user['permission_level'] > 0]
+        staff.sort(key=lambda row: row[1], reverse=True)
+        return staff
+
+    # Ники
+
+    async def get_chat_nicks(self, chat_id: int) -> dict:
+        return {user_id: user['nick'] for user_id, user in self.users.get(chat_id, {}).items()
+                if user['nick'] is not None}
+
+    async def set_nick(self, user_id: int, chat_id: int, nick: str):
+        self._user(user_id, chat_id)['nick'] = nick
+
+    async def remove_nick(self, user_id: int, chat_id: int):
+        user = self.users.get(chat_id, {}).get(user_id)
+        if user:
+            user['nick'] = None
+
+    # Разработчики
+
+    async def is_developer(self, user_id: int) -> bool:
+        return bool(self.devs.get(user_id))
+
+    async def get_developer_level(self, user_id: int, chat_id: int):
+        return self.devs.get(user_id, {}).get(chat_id)
+
+    async def set_developer_level(self, user_id: int, chat_id: int, level: int):
+        self.devs.setdefault(user_id, {})[chat_id] = level
+
+    async def remove_developer(self, user_id: int, chat_id: int):
+        levels = self.devs.get(user_id)
+        if levels:
+            levels.pop(chat_id, None)
+            if not levels:
+                del self.devs[user_id]
+
+    # Предупреждения
+
+    def _active_warns(self, chat_id: int, user_id: int) -> list:
+        return [warn for warn in self.warns.get(chat_id, []) if warn['user_id'] == user_id and warn['active']]
+
+    @staticmethod
+    def _newest_first(warns: list) -> list:
+        return sorted(warns, key=lambda warn: (warn['warned_at'], warn['id']), reverse=True)
+
+    async def add_warn(self, chat_id: int, user_id: int, reason: str, warned_by: int) -> int:
+        self._warn_id += 1
+        self.warns.setdefault(chat_id, []).append({'id': self._warn_id, 'user_id': user_id, 'reason': reason,
+                                                   'warned_by': warned_by, 'warned_at': self._now(), 'active': 1})
+        return len(self._active_warns(chat_id, user_id))
+
+    async def remove_last_warn(self, chat_id: int, user_id: int):
+        active = self._newest_first(self._active_warns(chat_id, user_id))
+        if not active:
+            return None
+        active[0]['active'] = 0
+        return len(active) - 1
+
+    async def clear_warns(self, chat_id: int, user_id: int):
+        for warn in self._active_warns(chat_id, user_id):
+            warn['active'] = 0
+
+    async def get_active_warns(self, chat_id: int) -> list:
+        users = self.users.get(chat_id, {})
+        return [(warn['user_id'], warn['reason'], warn['warned_by'], warn['warned_at'],
+                 users.get(warn['user_id'], {}).get('nick'))
+                for warn in self._newest_first(self.warns.get(chat_id, [])) if warn['active']]
+
+    async def get_warn_history(self, chat_id: int, user_id: int, limit: int = 10) -> list:
+        warns = [warn for warn in self.warns.get(chat_id, []) if warn['user_id'] == user_id]
+        return [(warn['reason'], warn['warned_by'], warn['warned_at'], warn['active'])
+                for warn in self._newest_first(warns)[:limit]]
+
+    # Баны
+
+    async def add_ban(self, chat_id: int, user_id: int, end_time, reason: str, banned_by: int, banned_at: int):
+        self.bans[(chat_id, user_id)] = (end_time, reason, banned_by, banned_at)
+
+    async def remove_ban(self, chat_id: int, user_id: int) -> bool:
+        return self.bans.pop((chat_id, user_id), None) is not None
+
+    async def get_bans(self, chat_id: int, user_ids: list, now: int) -> dict:
+        bans = {}
+        for user_id in user_ids:
+            ban = self.bans.get((chat_id, user_id))
+            if ban and (ban[0] is None or ban[0] > now):
+                bans[user_id] = ban
+        return bans
+
+    @staticmethod
+    def _delete_expired(table: dict, expired: list):
+        for chat_id, user_id, end_time in expired:
+            row = table.get((chat_id, user_id))
+            if row and row[0] is not None and row[0] <= end_time:
+                del table[(chat_id, user_id)]
+
+    async def delete_expired_bans(self, expired: list):
+        self._delete_expired(self.bans, expired)
+
+    # Муты
+
+    async def add_mute(self, chat_id: int, user_id: int, end_time: int, reason: str):
+        self.mutes[(chat_id, user_id)] = (end_time, reason)
+
+    async def remove_mute(self, chat_id: int, user_id: int):
+        self.mutes.pop((chat_id, user_id), None)
+
+    async def delete_expired_mutes(self, expired: list):
+        self._delete_expired(self.mutes, expired)
+
+    # Отслеживаемые сообщения
+
+    async def add_messages(self, rows: list):
+        now = self._now()
+        for chat_id, user_id, cmid in rows:
+            self.messages.setdefault(chat_id, {}).setdefault(cmid, (user_id, now))
+
+    async def get_user_messages(self, chat_id: int, user_id: int) -> list:
+        return [(cmid, timestamp) for cmid, (author_id, timestamp) in self.messages.get(chat_id, {}).items()
+                if author_id == user_id]
+
+    async def delete_messages(self, chat_id: int, cmids) -> int:
+        chat_messages = self.messages.get(chat_id, {})
+        return sum(chat_messages.pop(cmid, None) is not None for cmid in cmids)
+
+    async def delete_messages_before(self, cutoff: str, limit: int) -> int:
+        deleted = 0
+        for chat_messages in self.messages.values():
+            for cmid in [cmid for cmid, (user_id, timestamp) in chat_messages.items() if timestamp < cutoff]:
+                if deleted >= limit:
+                    return deleted
+                del chat_messages[cmid]
+                deleted += 1
+        return deleted
+
+    async def reclaim_space(self, pages: int) -> tuple:
+        return 0, 0
+
+STORAGE_BACKENDS = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage,
 }
 
-# Глобальные переменные
-vk_token = Config.vk_token
-bot = None
-api = None
-database = None
-sql = None
-bot_running = True
+def create_storage(backend: str) -> Storage:
+    """Хранилище по имени из storage_backend"""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Неизвестное хранилище {backend!r}, доступны: {', '.join(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend]()
 
-# Система регистрации команд
-commands = {}
+storage = create_storage(STORAGE_BACKEND)
 
-def register_command(command_names, permission_level=PERMISSION_LEVELS['ZERO']):
-    def decorator(func):
-        for cmd in command_names:
-            commands[cmd.lower()] = (func, permission_level)  # Приводим к нижнему регистру
-        return func
-    return decorator
+def shutdown_database():
+    """Дожидается завершения запросов в очереди и закрывает хранилище"""
+    # Дописываем сообщения, которые ещё не успел сбросить буфер
+    storage.close(message_buffer.drain())
 
-# Инициализация бота и базы данных
-def initialize_bot():
-    global bot, api, database, sql
-    
+
+async def resolve_bot_context():
+    """Получает данные о группе бота при старте"""
     try:
-        logger.info("Попытка инициализации бота с токеном: %s", vk_token[:10] + "..." if vk_token else "None")
-        bot = Bot(token=vk_token)
-        api = API(vk_token)
-        logger.info("Бот и API успешно инициализированы")
+        await bot_context.get_group_id()
     except Exception as e:
-        logger.error(f"Ошибка при инициализации бота: {e}")
-        exit(1)
+        logger.error(f"Ошибка при получении ID группы бота: {e}")
 
+def load_chat_states():
+    """Загружает состояние всех активированных бесед в память"""
     try:
-        database = sqlite3.connect("database.db", check_same_thread=False)
-        sql = database.cursor()
-        logger.info("База данных успешно подключена")
+        chat_states.clear()
+        for chat_id, peer_id, owner_id, silence, welcome_message, leave_kick in storage.load_chats():
+            chat_states[chat_id] = ChatState(
+                chat_id, peer_id, owner_id,
+                silence or 0,
+                welcome_message or DEFAULT_WELCOME_MESSAGE,
+                1 if leave_kick is None else leave_kick
+            )
+        logger.info(f"Загружено состояние {len(chat_states)} бесед")
     except Exception as e:
-        logger.error(f"Ошибка при подключении к базе данных: {e}")
-        exit(1)
-    
-    # Инициализация таблиц
-    init_db()
+        logger.error(f"Ошибка при загрузке состояния бесед: {e}")
 
-def init_db():
-    """Инициализация таблиц базы данных"""
+def load_mutes():
+    """Загружает активные муты в память и удаляет истекшие из хранилища"""
     try:
-        sql.execute('''
-            CREATE TABLE IF NOT EXISTS warns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                reason TEXT,
-                warned_by INTEGER NOT NULL,
-                warned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                active INTEGER DEFAULT 1  -- 1 - активное предупреждение, 0 - снятое
-            )
-        ''')
-# В функции init_db() измените создание таблицы chats:
-        sql.execute('''
-            CREATE TABLE IF NOT EXISTS bans (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                end_time INTEGER,  -- NULL означает бессрочный бан
-                reason TEXT,
-                banned_by INTEGER NOT NULL,
-                banned_at INTEGER DEFAULT (strftime('%s', 'now')),  -- UNIX timestamp
-                UNIQUE(chat_id, user_id)
-            )
-        ''')
+        for chat_id, user_id, end_time in storage.load_active_mutes(int(time.time())):
+            # В режиме шардирования каждый процесс следит только за своими беседами
+            if owns_chat(chat_id):
+                mute_registry.add(chat_id, user_id, end_time)
+        logger.info(f"Загружено {len(mute_registry)} активных мутов")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке мутов: {e}")
 
-        sql.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id INTEGER PRIMARY KEY,
-                peer_id INTEGER,
-                owner_id INTEGER,
-                silence INTEGER DEFAULT 0,
-                welcome_message TEXT DEFAULT 'Добро пожаловать в беседу!',
-                leave_kick INTEGER DEFAULT 1,  -- Новое поле: 1 - включено, 0 - выключено
-                settings TEXT DEFAULT '{}',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+async def delete_expired_mutes(expired: list):
+    """Удаляет из хранилища муты, истекшие в памяти"""
+    await storage.delete_expired_mutes(expired)
+    logger.info(f"Удалено истекших мутов: {len(expired)}")
 
-        sql.execute('''
-            CREATE TABLE IF NOT EXISTS mutes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                end_time INTEGER NOT NULL,
-                reason TEXT,
-                UNIQUE(chat_id, user_id)
-            )
-        ''')
-        
-        sql.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER,
-                chat_id INTEGER,
-                permission_level INTEGER DEFAULT 0,
-                nick TEXT,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        """)
-        
-        sql.execute("""
-            CREATE TABLE IF NOT EXISTS devs (
-                user_id INTEGER,
-                chat_id INTEGER,
-                previous_level INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        """)
-        
-        # Новая таблица для сообщений
-        sql.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                chat_id INTEGER,
-                user_id INTEGER,
-                cmid INTEGER,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (chat_id, cmid)
-            )
-        """)
-        
-        database.commit()
-        logger.info("Таблицы базы данных инициализированы")
+async def mute_expiry_worker():
+    """Фоновая задача снятия истекших мутов"""
+    await mute_registry.run_expiry_worker(delete_expired_mutes)
+
+# Истекшие баны удаляются из таблицы пачками: после срока ждём ban_expiry_batch_seconds,
+# чтобы собрать соседние сроки, и пишем не больше ban_expiry_batch_size строк за транзакцию
+BAN_EXPIRY_BATCH_SECONDS = getattr(Config, 'ban_expiry_batch_seconds', 30)
+BAN_EXPIRY_BATCH_SIZE = getattr(Config, 'ban_expiry_batch_size', 500)
+
+def load_bans():
+    """Загружает активные баны в память и удаляет истекшие из хранилища"""
+    try:
+        for chat_id, user_id, end_time in storage.load_active_bans(int(time.time())):
+            # В режиме шардирования каждый процесс следит только за своими беседами
+            if owns_chat(chat_id):
+                ban_index.add(chat_id, user_id, end_time)
+        logger.info(f"Загружено {len(ban_index)} активных банов")
     except Exception as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
+        logger.error(f"Ошибка при загрузке банов: {e}")
+
+async def delete_expired_bans(expired: list):
+    """Удаляет из хранилища баны, истекшие в памяти"""
+    for start in range(0, len(expired), BAN_EXPIRY_BATCH_SIZE):
+        await storage.delete_expired_bans(expired[start:start + BAN_EXPIRY_BATCH_SIZE])
+    logger.info(f"Удалено истекших банов: {len(expired)}")
+
+async def ban_expiry_worker():
+    """Фоновая задача снятия истекших банов"""
+    await ban_index.run_expiry_worker(delete_expired_bans, BAN_EXPIRY_BATCH_SECONDS)
+
+def get_chat_state(chat_id) -> ChatState:
+    """Возвращает состояние беседы или None, если бот в ней не активирован"""
+    return chat_states.get(chat_id)
 
 
 def format_time(seconds: int) -> str:
@@ -189,130 +2601,260 @@ async def kick_user(peer_id: int, user_id: int, reason: str = None) -> bool:
             user_id=user_id
         )
         
-        logger.info(f"Пользователь {user_id} успешно кикнут из беседы {peer_id}. Причина: {reason}")
+        logger.info("Пользователь %s успешно кикнут из беседы %s. Причина: %s", user_id, peer_id, reason)
+        metrics.inc('vkbot_kicks_total', result='ok')
         return True
         
     except Exception as e:
+        metrics.inc('vkbot_kicks_total', result='failed')
         error_msg = str(e).lower()
         
         if "permissions" in error_msg:
-            logger.error(f"Недостаточно прав для кика пользователя {user_id} из беседы {peer_id}")
+            logger.error("Недостаточно прав для кика пользователя %s из беседы %s", user_id, peer_id)
         elif "not found" in error_msg:
-            logger.error(f"Пользователь {user_id} или беседа {peer_id} не найдены")
+            logger.error("Пользователь %s или беседа %s не найдены", user_id, peer_id)
         elif "kick yourself" in error_msg:
-            logger.error(f"Попытка кикнуть самого себя (пользователь {user_id})")
+            logger.error("Попытка кикнуть самого себя (пользователь %s)", user_id)
         elif "user not in chat" in error_msg:
-            logger.error(f"Пользователь {user_id} не находится в беседе {peer_id}")
+            logger.error("Пользователь %s не находится в беседе %s", user_id, peer_id)
         else:
-            logger.error(f"Неизвестная ошибка при кике пользователя {user_id}: {e}")
+            logger.error("Неизвестная ошибка при кике пользователя %s: %s", user_id, e)
         
         return False
 
-async def check_ban_and_kick(message: Message, user_id: int):
-    logger.info(f"Проверка бана для пользователя {user_id} в чате {message.chat_id}")
-    
-    chat_id = message.chat_id
-    peer_id = message.peer_id
+# Максимальная длина текста одного сообщения VK
+MESSAGE_TEXT_LIMIT = 4096
+
+def _format_timestamp(value) -> str:
+    """Время бана из таблицы bans: timestamp или строка SQLite"""
+    try:
+        # Если banned_at - это timestamp (число)
+        value_dt = datetime.fromtimestamp(int(value))
+    except (ValueError, TypeError):
+        # Если banned_at - это строка в формате SQLite
+        try:
+            value_dt = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        except (ValueError, TypeError):
+            # Если не удалось распарсить, используем текущее время
+            value_dt = datetime.now()
+    return value_dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def _format_unban_time(end_time):
+    """Время разбана или None для бессрочного бана"""
+    if end_time is None:
+        return None
+    try:
+        return datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
+    except (ValueError, TypeError):
+        return None
+
+def format_ban_notice(target_mention: str, banned_by_mention: str, end_time, reason, banned_at) -> str:
+    """Подробное уведомление о забаненном пользователе, который попытался войти"""
+    ban_message = (
+        f"🚫 {target_mention} был забанен и не может присоединиться к беседе.\n"
+        f"Забанен: {banned_by_mention}\n"
+        f"Время бана: {_format_timestamp(banned_at)}\n"
+    )
+    unban_time = _format_unban_time(end_time)
+    if unban_time is None:
+        ban_message += "Срок: навсегда\n"
+    else:
+        ban_message += f"Разбан: {unban_time}\n"
     
+    if reason:
+        ban_message += f"Причина: {reason}"
+    return ban_message
+
+def chunk_lines(lines: list, header: str = "", limit: int = MESSAGE_TEXT_LIMIT, separator: str = "\n") -> list:
+    """Склеивает строки в сообщения не длиннее limit символов, header - в начало первого"""
+    chunks = []
+    current = [header] if header else []
+    size = len(header) if header else -len(separator)
+    for line in lines:
+        if current and size + len(separator) + len(line) > limit:
+            chunks.append(separator.join(current))
+            current, size = [], -len(separator)
+        current.append(line)
+        size += len(separator) + len(line)
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+async def send_chat_message(peer_id: int, text: str, what: str):
+    """Отправляет сообщение в беседу (не как ответ на сервисное сообщение)"""
+    try:
+        await bot.api.messages.send(peer_id=peer_id, message=text, random_id=0)
+    except Exception as e:
+        logger.error("Ошибка при отправке %s: %s", what, e)
+
+@measure_latency
+async def process_joins(chat_id: int, peer_id: int, user_ids: list):
+    """
+    Проверка банов для пачки вошедших в беседу пользователей: забаненных находит
+    ban_index, подробности их банов берутся из хранилища одним запросом,
+    кики уходят через execute-пакеты, а вместо сообщения на каждого - одно общее
+    уведомление о банах и одно приветствие
+    """
     # Проверяем, активирован ли бот в этом чате
     if not await check_chat(chat_id):
-        logger.info(f"Бот не активирован в чате {chat_id}, пропускаем проверку бана")
+        logger.info("Бот не активирован в чате %s, пропускаем проверку бана", chat_id)
         return
     
     current_time = int(time.time())
     
-    # Проверяем, есть ли запись о бане для этого пользователя
-    sql.execute("""
-        SELECT end_time, reason, banned_by, banned_at 
-        FROM bans 
-        WHERE chat_id = ? AND user_id = ? AND (end_time IS NULL OR end_time > ?)
-    """, (chat_id, user_id, current_time))
-    ban_result = sql.fetchone()
+    # Кто забанен, знает ban_index; в хранилище идём только за подробностями их банов
+    bans = {}
+    candidates = ban_index.banned_among(chat_id, user_ids, current_time)
+    if candidates:
+        bans = await storage.get_bans(chat_id, candidates, current_time)
+    banned = [user_id for user_id in user_ids if user_id in bans]
+    welcomed = [user_id for user_id in user_ids if user_id not in bans]
     
-    if ban_result:
-        logger.info(f"Пользователь {user_id} забанен в чате {chat_id}")
-        end_time, reason, banned_by, banned_at = ban_result
-        
-        # Преобразуем banned_at в datetime объект
-        try:
-            # Если banned_at - это timestamp (число)
-            banned_at_dt = datetime.fromtimestamp(int(banned_at))
-        except (ValueError, TypeError):
-            # Если banned_at - это строка в формате SQLite
-            try:
-                banned_at_dt = datetime.strptime(banned_at, "%Y-%m-%d %H:%M:%S")
-            except (ValueError, TypeError):
-                # Если не удалось распарсить, используем текущее время
-                banned_at_dt = datetime.now()
-        
-        banned_at_str = banned_at_dt.strftime("%Y-%m-%d %H:%M:%S")
+    tasks = []
+    if banned:
+        logger.info("Забаненные пользователи %s пытались войти в чат %s", banned, chat_id)
+        mentions = await get_user_mentions(banned + [bans[user_id][2] for user_id in banned], chat_id)
         
-        # Получаем информацию о том, кто забанил
-        banned_by_mention = await get_user_mention(banned_by, chat_id)
-        target_mention = await get_user_mention(user_id, chat_id)
+        # Кики и уведомление уходят общими execute
+        for user_id in banned:
+            reason = bans[user_id][1]
+            tasks.append(kick_user(peer_id, user_id, f"Автоматический кик забаненного пользователя: {reason}"))
         
-        # Формируем сообщение
-        ban_message = (
-            f"🚫 {target_mention} был забанен и не может присоединиться к беседе.\n"
-            f"Забанен: {banned_by_mention}\n"
-            f"Время бана: {banned_at_str}\n"
-        )
-        if end_time is None:
-            ban_message += "Срок: навсегда\n"
+        if len(banned) == 1:
+            user_id = banned[0]
+            end_time, reason, banned_by, banned_at = bans[user_id]
+            notices = [format_ban_notice(mentions[user_id], mentions[banned_by], end_time, reason, banned_at)]
         else:
-            try:
-                end_time_dt = datetime.fromtimestamp(int(end_time))
-                end_time_str = end_time_dt.strftime("%Y-%m-%d %H:%M:%S")
-                ban_message += f"Разбан: {end_time_str}\n"
-            except (ValueError, TypeError):
-                ban_message += "Срок: навсегда\n"
-        
-        if reason:
-            ban_message += f"Причина: {reason}"
-        
-        # Кикаем пользователя с помощью универсальной функции
-        kick_success = await kick_user(peer_id, user_id, f"Автоматический кик забаненного пользователя: {reason}")
-        
-        # Отправляем сообщение о блокировке (не как ответ на сервисное сообщение)
+            lines = []
+            for user_id in banned:
+                end_time, reason, banned_by, banned_at = bans[user_id]
+                unban_time = _format_unban_time(end_time)
+                term = f"до {unban_time}" if unban_time else "навсегда"
+                line = f"• {mentions[user_id]} - забанил {mentions[banned_by]}, срок: {term}"
+                if reason:
+                    line += f", причина: {reason}"
+                lines.append(line)
+            notices = chunk_lines(lines, f"🚫 {len(banned)} забаненных пользователей не могут присоединиться к беседе:")
+        tasks.extend(send_chat_message(peer_id, notice, "сообщения о бане") for notice in notices)
+    
+    if welcomed:
+        if log_sampler.sample('chat_action'):
+            logger.info("Пользователи %s не забанены в чате %s", welcomed, chat_id, extra={'event': 'chat_action'})
+        # Одно приветствие на всех незабаненных: {user} заменяется списком упоминаний
         try:
-            await bot.api.messages.send(
-                peer_id=peer_id,
-                message=ban_message,
-                random_id=0
-            )
+            welcome_message = await get_welcome_message(chat_id)
+            mentions = await get_user_mentions(welcomed, chat_id, short=True)
+            limit = MESSAGE_TEXT_LIMIT - len(welcome_message)
+            for group in chunk_lines([mentions[user_id] for user_id in welcomed], limit=limit, separator=", "):
+                formatted_message = welcome_message.replace("{user}", group)
+                tasks.append(send_chat_message(peer_id, formatted_message, "приветственного сообщения"))
         except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения о бане: {e}")
-    else:
-        logger.info(f"Пользователь {user_id} не забанен в чате {chat_id}")
-        # Отправляем приветственное сообщение для незабаненного пользователя
+            logger.error("Ошибка при отправке приветственного сообщения: %s", e)
+    
+    await asyncio.gather(*tasks)
+
+@measure_latency
+async def check_ban_and_kick(message: Message, user_id: int):
+    if log_sampler.sample('chat_action'):
+        logger.info("Проверка бана для пользователя %s в чате %s", user_id, message.chat_id, extra={'event': 'chat_action'})
+    await process_joins(message.chat_id, message.peer_id, [user_id])
+
+class JoinBatcher:
+    """
+    Копит входы в беседу за окно window_ms и проверяет их одной пачкой
+    (process_joins). Во время рейда с приглашениями сотня входов превращается
+    в один запрос к bans, несколько execute с киками и пару сообщений вместо
+    сотни приветствий. Пачка уходит раньше, если набралось max_size входов.
+    window_ms = 0 отключает накопление
+    """
+
+    def __init__(self, window_ms: float = 500, max_size: int = 100):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._pending = {}  # chat_id -> (peer_id, [user_id, ...])
+        self._timers = {}
+        self._tasks = set()
+        self._loop = None
+        self.joins = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def add(self, chat_id: int, peer_id: int, user_id: int):
+        self.joins += 1
+        entry = self._pending.get(chat_id)
+        if entry is None:
+            entry = self._pending[chat_id] = (peer_id, [])
+            self._loop = asyncio.get_running_loop()
+            self._timers[chat_id] = self._loop.call_later(self.window, self._start_flush, chat_id)
+        if user_id not in entry[1]:
+            entry[1].append(user_id)
+        if len(entry[1]) >= self.max_size:
+            self._start_flush(chat_id)
+
+    def _start_flush(self, chat_id: int):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        entry = self._pending.pop(chat_id, None)
+        if entry is None:
+            return
+        task = asyncio.ensure_future(self._process(chat_id, *entry))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, chat_id: int, peer_id: int, user_ids: list):
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(user_ids))
         try:
-            welcome_message = await get_welcome_message(chat_id)
-            user_mention = await get_user_mention_name(user_id, chat_id)
-            
-            # Заменяем плейсхолдеры в приветственном сообщении
-            formatted_message = welcome_message.replace("{user}", user_mention)
-            
-            await bot.api.messages.send(
-                peer_id=peer_id,
-                message=formatted_message,
-                random_id=0
-            )
+            await process_joins(chat_id, peer_id, user_ids)
+        except Exception as e:
+            logger.error("Ошибка при обработке входов в чат %s: %s", chat_id, e)
+
+    async def flush(self):
+        """Обрабатывает накопленные входы, не дожидаясь окна"""
+        for chat_id in list(self._pending):
+            self._start_flush(chat_id)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+    def flush_from_thread(self, timeout: float = 10):
+        """flush() из другого потока (команда stop из консоли), пока цикл событий ещё работает"""
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.flush(), loop).result(timeout)
         except Exception as e:
-            logger.error(f"Ошибка при отправке приветственного сообщения: {e}")
+            logger.error("Не удалось обработать входы в беседы перед остановкой: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            'pending': sum(len(entry[1]) for entry in self._pending.values()),
+            'joins': self.joins,
+            'batches': self.batches,
+            'max_batch': self.max_batch
+        }
+
+join_batcher = JoinBatcher(
+    getattr(Config, 'join_batch_window_ms', 500),
+    getattr(Config, 'join_batch_max_size', 100)
+)
 
 async def delete_messages(peer_id: int, cmids: list, group_id: int = None) -> bool:
     """
     Удаляет сообщения в беседе
     :param peer_id: ID беседы
     :param cmids: Список ID сообщений для удаления
-    :param group_id: ID группы бота (если не указан, будет получен автоматически)
+    :param group_id: ID группы бота (если не указан, берётся из bot_context)
     :return: True если удаление прошло успешно, False в случае ошибки
     """
     try:
-        # Если group_id не указан, получаем его
         if group_id is None:
-            group_info = await bot.api.groups.get_by_id()
-            group_id = group_info.groups[0].id
+            group_id = await bot_context.get_group_id()
         
         # Удаляем сообщения
         await bot.api.messages.delete(
@@ -321,17 +2863,66 @@ async def delete_messages(peer_id: int, cmids: list, group_id: int = None) -> bo
             delete_for_all=1,
             cmids=cmids
         )
+        metrics.inc('vkbot_deleted_messages_total', len(cmids))
         return True
     except Exception as e:
-        logger.error(f"Ошибка при удалении сообщений: {e}")
+        bot_context.handle_api_error(e)
+        logger.error("Ошибка при удалении сообщений: %s", e)
         return False
 
+# Ограничения messages.delete: не больше 100 cmid за вызов,
+# удалить для всех можно только сообщения не старше 24 часов
+DELETE_CHUNK_SIZE = 100
+DELETE_WINDOW_SECONDS = 24 * 60 * 60
+DELETE_CONCURRENCY = getattr(Config, 'delete_concurrency', 3)
+
+async def _delete_chunk(peer_id: int, cmids: list, group_id: int) -> list:
+    """Удаляет одну пачку сообщений и возвращает cmid, удаление которых подтвердил VK"""
+    try:
+        items = await bot.api.messages.delete(
+            group_id=group_id,
+            peer_id=peer_id,
+            delete_for_all=1,
+            cmids=cmids
+        )
+    except Exception as e:
+        bot_context.handle_api_error(e)
+        logger.error("Ошибка при удалении пачки из %s сообщений: %s", len(cmids), e)
+        return []
+    
+    confirmed = []
+    for item in items or []:
+        if item.response and item.conversation_message_id is not None:
+            confirmed.append(item.conversation_message_id)
+        elif item.error:
+            logger.info("VK не удалил сообщение %s: %s", item.conversation_message_id, item.error)
+    metrics.inc('vkbot_deleted_messages_total', len(confirmed))
+    return confirmed
+
+async def delete_messages_bulk(peer_id: int, cmids: list) -> list:
+    """
+    Удаляет много сообщений: разбивает cmid на пачки по DELETE_CHUNK_SIZE
+    и отправляет их параллельно, не больше DELETE_CONCURRENCY запросов одновременно
+    :return: Список cmid, удаление которых подтверждено
+    """
+    if not cmids:
+        return []
+    group_id = await bot_context.get_group_id()
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+    
+    async def run_chunk(chunk):
+        async with semaphore:
+            return await _delete_chunk(peer_id, chunk, group_id)
+    
+    chunks = [cmids[i:i + DELETE_CHUNK_SIZE] for i in range(0, len(cmids), DELETE_CHUNK_SIZE)]
+    results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+    return [cmid for confirmed in results for cmid in confirmed]
+
 async def is_global_developer(user_id: int) -> bool:
     """Проверяет, является ли пользователь глобальным разработчиком"""
     try:
-        # Проверяем наличие пользователя в таблице devs (любая запись)
-        sql.execute("SELECT * FROM devs WHERE user_id = ? LIMIT 1", (user_id,))
-        return sql.fetchone() is not None
+        # Проверяем наличие пользователя среди разработчиков (любая запись)
+        return await storage.is_developer(user_id)
     except Exception as e:
         logger.error(f"Ошибка при проверке глобального разработчика {user_id}: {e}")
         return False
@@ -339,10 +2930,8 @@ async def is_global_developer(user_id: int) -> bool:
 async def get_developer_previous_level(user_id: int, chat_id: int) -> int:
     """Получает предыдущий уровень прав разработчика в беседе"""
     try:
-        sql.execute("SELECT previous_level FROM devs WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        result = sql.fetchone()
-        return result[0] if result else PERMISSION_LEVELS['ZERO']
+        level = await storage.get_developer_level(user_id, chat_id)
+        return level if level is not None else PERMISSION_LEVELS['ZERO']
     except Exception as e:
         logger.error(f"Ошибка при получении предыдущего уровня разработчика {user_id}: {e}")
         return PERMISSION_LEVELS['ZERO']
@@ -350,12 +2939,7 @@ async def get_developer_previous_level(user_id: int, chat_id: int) -> int:
 async def set_developer_previous_level(user_id: int, chat_id: int, level: int) -> bool:
     """Устанавливает предыдущий уровень прав разработчика в беседе"""
     try:
-        sql.execute(
-            """INSERT OR REPLACE INTO devs (user_id, chat_id, previous_level) 
-               VALUES (?, ?, ?)""",
-            (user_id, chat_id, level)
-        )
-        database.commit()
+        await storage.set_developer_level(user_id, chat_id, level)
         return True
     except Exception as e:
         logger.error(f"Ошибка при установке предыдущего уровня разработчика {user_id}: {e}")
@@ -364,21 +2948,27 @@ async def set_developer_previous_level(user_id: int, chat_id: int, level: int) -
 async def remove_developer(user_id: int, chat_id: int) -> bool:
     """Удаляет разработчика из беседы"""
     try:
-        sql.execute("DELETE FROM devs WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        database.commit()
+        await storage.remove_developer(user_id, chat_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка при удалении разработчика {user_id}: {e}")
         return False
 
+async def get_chat_nicks(chat_id: int) -> dict:
+    """Все ники беседы {user_id: nick} через кэш ников"""
+    nicks = nick_cache.get_chat(chat_id)
+    if nicks is not None:
+        return nicks
+    
+    generation = nick_cache.generation
+    nicks = await storage.get_chat_nicks(chat_id)
+    nick_cache.put_chat(chat_id, nicks, generation)
+    return nicks
+
 async def get_user_nick(user_id: int, chat_id: int) -> str:
     """Получение ника пользователя"""
     try:
-        sql.execute("SELECT nick FROM users WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        result = sql.fetchone()
-        return result[0] if result else None
+        return (await get_chat_nicks(chat_id)).get(user_id)
     except Exception as e:
         logger.error(f"Ошибка при получении ника пользователя {user_id}: {e}")
         return None
@@ -386,25 +2976,8 @@ async def get_user_nick(user_id: int, chat_id: int) -> str:
 async def set_user_nick(user_id: int, chat_id: int, nick: str) -> bool:
     """Установка ника пользователю без изменения прав"""
     try:
-        # Сначала проверяем, существует ли уже запись для этого пользователя
-        sql.execute("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        result = sql.fetchone()
-        
-        if result:
-            # Если запись существует, обновляем только ник
-            sql.execute(
-                "UPDATE users SET nick = ? WHERE user_id = ? AND chat_id = ?",
-                (nick, user_id, chat_id)
-            )
-        else:
-            # Если записи нет, создаем новую с уровнем прав по умолчанию (0) и ником
-            sql.execute(
-                "INSERT INTO users (user_id, chat_id, permission_level, nick) VALUES (?, ?, ?, ?)",
-                (user_id, chat_id, 0, nick)
-            )
-        
-        database.commit()
+        await storage.set_nick(user_id, chat_id, nick)
+        nick_cache.invalidate(chat_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка при установке ника пользователю {user_id}: {e}")
@@ -413,11 +2986,8 @@ async def set_user_nick(user_id: int, chat_id: int, nick: str) -> bool:
 async def remove_user_nick(user_id: int, chat_id: int) -> bool:
     """Удаление ника пользователя"""
     try:
-        sql.execute(
-            "UPDATE users SET nick = NULL WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id)
-        )
-        database.commit()
+        await storage.remove_nick(user_id, chat_id)
+        nick_cache.invalidate(chat_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка при удалении ника пользователя {user_id}: {e}")
@@ -426,45 +2996,65 @@ async def remove_user_nick(user_id: int, chat_id: int) -> bool:
 async def get_all_nicks(chat_id: int) -> list:
     """Получение всех ников в чате"""
     try:
-        sql.execute("SELECT user_id, nick FROM users WHERE chat_id = ? AND nick IS NOT NULL", 
-                   (chat_id,))
-        return sql.fetchall()
+        return list((await get_chat_nicks(chat_id)).items())
     except Exception as e:
         logger.error(f"Ошибка при получении списка ников: {e}")
         return []
 
-def console_listener():
-    """Прослушивает команды из консоли для управления ботом"""
+def console_listener(on_stop=None):
+    """
+    Прослушивает команды из консоли для управления ботом
+    :param on_stop: Что сделать по команде остановки вместо немедленного выхода
+    """
     while True:
         try:
             command = input().lower().strip()
             if command in ['с', 'stop', 'exit', 'quit']:
                 logger.info("Получена команда остановки из консоли")
-                # Закрываем соединение с базой данных
-                if database:
-                    database.close()
+                if on_stop is not None:
+                    on_stop()
+                    return
+                # Входы из окна join_batcher ещё не проверены на бан - проверяем до закрытия базы
+                join_batcher.flush_from_thread()
+                # Дожидаемся запросов в очереди и закрываем соединение с базой данных
+                shutdown_database()
+                # os._exit не вызывает atexit: дописываем очередь логов сами
+                log_listener.stop()
                 # Выходим из программы
                 os._exit(0)
+            elif command == 'stats':
+                logger.info(f"Кэш прав: {permission_cache.stats()}")
+                logger.info(f"Буфер сообщений: {message_buffer.stats()}")
+                logger.info(f"Кэш профилей: {profile_resolver.stats()}")
+                logger.info(f"Очистка сообщений: {message_retention.stats()}")
+                logger.info(f"Кэш ников: {nick_cache.stats()}")
+                logger.info(f"Кэш коротких имён: {screen_name_resolver.stats()}")
+                logger.info(f"Исходящие запросы VK: {outbound_scheduler.stats()}")
+                logger.info(f"Очереди бесед: {chat_dispatcher.stats()}")
+                logger.info(f"Пачки входов: {join_batcher.stats()}")
+                logger.info(f"Активных банов в памяти: {len(ban_index)}, мутов: {len(mute_registry)}")
+                if isinstance(bot.api, ScheduledAPI):
+                    logger.info(f"Пакетирование execute: {bot.api.batcher.stats()}")
         except Exception as e:
             logger.error(f"Ошибка в консольном слушателе: {e}")
             break
 
 async def check_chat(chat_id):
     """Проверка, зарегистрирован ли чат в базе"""
-    try:
-        sql.execute("SELECT * FROM chats WHERE chat_id = ?", (chat_id,))
-        return sql.fetchone() is not None
-    except Exception as e:
-        logger.error(f"Ошибка при проверке чата {chat_id}: {e}")
-        return False
+    return chat_id in chat_states
 
 async def get_user_permission(user_id, chat_id):
     """Получение уровня прав пользователя"""
+    level = permission_cache.get(user_id, chat_id)
+    if level is not None:
+        return level
+    
     try:
-        sql.execute("SELECT permission_level FROM users WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        result = sql.fetchone()
-        return result[0] if result else 0
+        generation = permission_cache.generation
+        level = await storage.get_permission(user_id, chat_id)
+        level = level if level is not None else 0
+        permission_cache.put(user_id, chat_id, level, generation)
+        return level
     except Exception as e:
         logger.error(f"Ошибка при получении прав пользователя {user_id}: {e}")
         return 0
@@ -472,44 +3062,12 @@ async def get_user_permission(user_id, chat_id):
 async def set_user_permission(user_id, chat_id, level):
     """Установка уровня прав пользователя с сохранением ника и обработкой разработчиков"""
     try:
-        # Сначала получаем текущий ник пользователя (если есть)
-        current_nick = await get_user_nick(user_id, chat_id)
-        
-        # Проверяем, существует ли запись
-        sql.execute("SELECT * FROM users WHERE user_id = ? AND chat_id = ?", 
-                   (user_id, chat_id))
-        result = sql.fetchone()
-        
-        if result:
-            # Если запись существует, обновляем только уровень прав
-            sql.execute(
-                "UPDATE users SET permission_level = ? WHERE user_id = ? AND chat_id = ?",
-                (level, user_id, chat_id)
-            )
-        else:
-            # Если записи нет, создаем новую
-            if current_nick:
-                sql.execute(
-                    "INSERT INTO users (user_id, chat_id, permission_level, nick) VALUES (?, ?, ?, ?)",
-                    (user_id, chat_id, level, current_nick)
-                )
-            else:
-                sql.execute(
-                    "INSERT INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
-                    (user_id, chat_id, level)
-                )
-        
-        # Если пользователь является разработчиком и устанавливается не уровень 4,
-        # обновляем предыдущий уровень в таблице devs
-        if await is_global_developer(user_id) and level != PERMISSION_LEVELS['FOUR']:
-            await set_developer_previous_level(user_id, chat_id, level)
-        
-        database.commit()
+        await storage.set_permission(user_id, chat_id, level)
+        permission_cache.invalidate(user_id, chat_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка при установке прав пользователя {user_id}: {e}")
         return False
-        return False
     
 async def can_manage_user(initiator_id: int, target_id: int, chat_id: int, allow_self_action: bool = False) -> bool:
     """
@@ -527,6 +3085,29 @@ async def can_manage_user(initiator_id: int, target_id: int, chat_id: int, allow
     
     return initiator_level > target_level
 
+# Шаблоны идентификаторов пользователей и групп
+MENTION_PATTERN = re.compile(r'\[(id|club|public)(\d+)\|')
+VK_LINK_PATTERN = re.compile(r'^(https?://)?(www\.)?vk\.com/(?P<username>[a-zA-Z0-9_\.]+)/?$')
+NUMERIC_SCREEN_NAME_PATTERN = re.compile(r'^(id|club|public)(\d+)$')
+
+async def resolve_screen_name(username: str) -> int:
+    """
+    ID по короткому имени: id123, club123 и public123 разбираются локально,
+    остальные имена - через кэш screen_name_resolver
+    """
+    numeric_match = NUMERIC_SCREEN_NAME_PATTERN.match(username)
+    if numeric_match:
+        entity_id = int(numeric_match.group(2))
+        # Для групп возвращаем отрицательный ID
+        return entity_id if numeric_match.group(1) == 'id' else -abs(entity_id)
+    
+    try:
+        return await screen_name_resolver.resolve(username)
+    except Exception as e:
+        logger.error(f"Ошибка при получении ID по короткому имени {username}: {e}")
+        return None
+
+@measure_latency
 async def extract_user_id(identifier: str, message: Message) -> int:
     """
     Извлекает ID пользователя или группы из различных форматов
@@ -544,7 +3125,7 @@ async def extract_user_id(identifier: str, message: Message) -> int:
             return int(identifier)
         
         # Если это упоминание в формате [id123|Name] или [club123|Name]
-        mention_match = re.search(r'\[(id|club|public)(\d+)\|', identifier)
+        mention_match = MENTION_PATTERN.search(identifier)
         if mention_match:
             entity_id = int(mention_match.group(2))
             # Для групп возвращаем отрицательный ID
@@ -554,48 +3135,22 @@ async def extract_user_id(identifier: str, message: Message) -> int:
                 return -abs(entity_id)  # Гарантируем отрицательный ID для групп
         
         # Если это ссылка на профиль VK или группу
-        vk_link_match = re.match(r'^(https?://)?(www\.)?vk\.com/(?P<username>[a-zA-Z0-9_\.]+)/?$', identifier)
+        vk_link_match = VK_LINK_PATTERN.match(identifier)
         if vk_link_match:
-            username = vk_link_match.group('username')
-            
-            # Если это группа (начинается с club или public)
-            if username.startswith(('club', 'public')):
-                try:
-                    group_id = int(username[4:] if username.startswith('club') else username[6:])
-                    return -abs(group_id)  # Гарантируем отрицательный ID для групп
-                except ValueError:
-                    pass
-            # Если это пользователь
-            else:
-                try:
-                    users = await bot.api.users.get(user_ids=username)
-                    if users:
-                        return users[0].id
-                except Exception:
-                    pass
+            return await resolve_screen_name(vk_link_match.group('username'))
         
         # Если это @username или @club123
         if identifier.startswith('@'):
             username = identifier[1:].strip()
-            if username.startswith(('club', 'public')):
-                try:
-                    group_id = int(username[4:] if username.startswith('club') else username[6:])
-                    return -abs(group_id)  # Гарантируем отрицательный ID для групп
-                except ValueError:
-                    pass
-            else:
-                try:
-                    users = await bot.api.users.get(user_ids=username)
-                    if users:
-                        return users[0].id
-                except Exception:
-                    pass
+            if username:
+                return await resolve_screen_name(username)
     
     except Exception as e:
         logger.error(f"Ошибка при извлечении ID пользователя/группы: {e}")
     
     return None
 
+@measure_latency
 async def get_user_mention(user_id: int, chat_id: int) -> str:
     """
     Возвращает упоминание пользователя с учетом ника
@@ -605,16 +3160,43 @@ async def get_user_mention(user_id: int, chat_id: int) -> str:
     if nick:
         return f"[id{user_id}|{nick}]"
     
-    # Если ника нет, получаем имя и фамилию через API
+    # Если ника нет, получаем имя и фамилию через кэш профилей
+    profile = await profile_resolver.get(user_id)
+    if profile:
+        return f"[id{user_id}|{profile.first_name} {profile.last_name}]"
+    
+    return f"[id{user_id}|Пользователь]"
+
+@measure_latency
+async def get_user_mentions(user_ids, chat_id: int, short: bool = False) -> dict:
+    """
+    Упоминания сразу для нескольких пользователей: {user_id: упоминание}.
+    Ники берутся одним запросом на беседу, профили без ников - одним пакетом,
+    поэтому списочные команды делают O(различных пользователей) обращений, а не O(строк).
+    short=True - только имя, как в get_user_mention_name
+    """
+    user_ids = set(user_ids)
     try:
-        users = await bot.api.users.get(user_ids=user_id)
-        if users:
-            user = users[0]
-            return f"[id{user_id}|{user.first_name} {user.last_name}]"
+        nicks = await get_chat_nicks(chat_id)
     except Exception as e:
-        logger.error(f"Ошибка при получении информации о пользователе {user_id}: {e}")
+        logger.error(f"Ошибка при получении ников беседы {chat_id}: {e}")
+        nicks = {}
     
-    return f"[id{user_id}|Пользователь]"
+    profiles = await profile_resolver.get_many(user_id for user_id in user_ids if not nicks.get(user_id))
+    
+    mentions = {}
+    for user_id in user_ids:
+        nick = nicks.get(user_id)
+        profile = profiles.get(user_id)
+        if nick:
+            mentions[user_id] = f"[id{user_id}|{nick}]"
+        elif profile and short:
+            mentions[user_id] = f"[id{user_id}|{profile.first_name}]"
+        elif profile:
+            mentions[user_id] = f"[id{user_id}|{profile.first_name} {profile.last_name}]"
+        else:
+            mentions[user_id] = f"[id{user_id}|Пользователь]"
+    return mentions
 
 
 async def get_user_mention_name(user_id: int, chat_id: int) -> str:
@@ -626,29 +3208,20 @@ async def get_user_mention_name(user_id: int, chat_id: int) -> str:
     if nick:
         return f"[id{user_id}|{nick}]"
     
-    # Если ника нет, получаем имя и фамилию через API
-    try:
-        users = await bot.api.users.get(user_ids=user_id)
-        if users:
-            user = users[0]
-            return f"[id{user_id}|{user.first_name}]"
-    except Exception as e:
-        logger.error(f"Ошибка при получении информации о пользователе {user_id}: {e}")
+    # Если ника нет, получаем имя через кэш профилей
+    profile = await profile_resolver.get(user_id)
+    if profile:
+        return f"[id{user_id}|{profile.first_name}]"
     
     return f"[id{user_id}|Пользователь]"
 
 async def get_staff_members(chat_id: int) -> dict:
     """Получает участников с правами в беседе, сгруппированных по уровням"""
     try:
-        sql.execute("""
-            SELECT user_id, permission_level, nick 
-            FROM users 
-            WHERE chat_id = ? AND permission_level > 0 
-            ORDER BY permission_level DESC
-        """, (chat_id,))
+        rows = await storage.get_staff(chat_id)
         
         staff_members = {}
-        for user_id, level, nick in sql.fetchall():
+        for user_id, level, nick in rows:
             if level not in staff_members:
                 staff_members[level] = []
             staff_members[level].append((user_id, nick))
@@ -660,13 +3233,8 @@ async def get_staff_members(chat_id: int) -> dict:
     
 async def get_welcome_message(chat_id: int) -> str:
     """Получает приветственное сообщение для чата"""
-    try:
-        sql.execute("SELECT welcome_message FROM chats WHERE chat_id = ?", (chat_id,))
-        result = sql.fetchone()
-        return result[0] if result and result[0] else "Добро пожаловать в беседу!"
-    except Exception as e:
-        logger.error(f"Ошибка при получении приветственного сообщения: {e}")
-        return "Добро пожаловать в беседу!"
+    state = get_chat_state(chat_id)
+    return state.welcome_message if state and state.welcome_message else DEFAULT_WELCOME_MESSAGE
 
 
 
@@ -732,25 +3300,16 @@ async def start_command(message, args):
     
     # Активация бота
     try:
-        sql.execute("INSERT INTO chats (chat_id, peer_id, owner_id, silence, welcome_message, leave_kick) VALUES (?, ?, ?, 0, 'Добро пожаловать в беседу!', 1)",
-                   (chat_id, peer_id, user_id))
-        
         # Получаем информацию о пользователе для установки ника
-        try:
-            users = await bot.api.users.get(user_ids=user_id)
-            if users:
-                user = users[0]
-                nick = f"{user.first_name} {user.last_name}"
-                sql.execute("INSERT INTO users (user_id, chat_id, permission_level, nick) VALUES (?, ?, ?, ?)",
-                           (user_id, chat_id, PERMISSION_LEVELS['THREE'], nick))
-            else:
-                sql.execute("INSERT INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
-                           (user_id, chat_id, PERMISSION_LEVELS['THREE']))
-        except Exception:
-            sql.execute("INSERT INTO users (user_id, chat_id, permission_level) VALUES (?, ?, ?)",
-                       (user_id, chat_id, PERMISSION_LEVELS['THREE']))
+        nick = None
+        profile = await profile_resolver.get(user_id)
+        if profile:
+            nick = f"{profile.first_name} {profile.last_name}"
         
-        database.commit()
+        await storage.create_chat(chat_id, peer_id, user_id, nick)
+        permission_cache.invalidate(user_id, chat_id)
+        nick_cache.invalidate(chat_id)
+        chat_states[chat_id] = ChatState(chat_id, peer_id, user_id)
         
         await message.reply("✅ Бот успешно активирован!\n\nДля просмотра доступных команд напишите /help")
     except Exception as e:
@@ -803,17 +3362,8 @@ async def warn_command(message, args):
     target_mention = await get_user_mention(target_id, chat_id)
 
     try:
-        # Добавляем предупреждение в базу данных
-        sql.execute(
-            "INSERT INTO warns (chat_id, user_id, reason, warned_by, active) VALUES (?, ?, ?, ?, 1)",
-            (chat_id, target_id, reason, user_id)
-        )
-        database.commit()
-        
-        # Получаем количество активных предупреждений пользователя
-        sql.execute("SELECT COUNT(*) FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1", 
-                   (chat_id, target_id))
-        warn_count = sql.fetchone()[0]
+        # Добавляем предупреждение в базу данных и получаем количество активных предупреждений
+        warn_count = await storage.add_warn(chat_id, target_id, reason, user_id)
         
         # Формируем сообщение об успехе
         success_message = f"⚠️ {initiator_mention} выдал(а) предупреждение {target_mention}.\nВсего предупреждений: {warn_count}/3"
@@ -824,20 +3374,21 @@ async def warn_command(message, args):
         if warn_count >= 3:
             success_message += f"\n\n🚫 {target_mention} получил(а) 3 или более предупреждений и будет исключен(а) из беседы."
             
-            # Кикаем пользователя
-            kick_success = await kick_user(message.peer_id, target_id, f"Получено {warn_count} предупреждений")
+            # Кик и подтверждение уходят одним execute
+            kick_success, _ = await asyncio.gather(
+                kick_user(message.peer_id, target_id, f"Получено {warn_count} предупреждений"),
+                message.reply(success_message)
+            )
             
             # Снимаем все активные предупреждения пользователя (без уведомления в чат)
             if kick_success:
-                sql.execute("UPDATE warns SET active = 0 WHERE chat_id = ? AND user_id = ? AND active = 1",
-                           (chat_id, target_id))
-                database.commit()
+                await storage.clear_warns(chat_id, target_id)
                 logger.info(f"Сняты все предупреждения пользователя {target_id} после автоматического кика")
             else:
-                success_message += "\n⚠️ Не удалось исключить пользователя из беседы."
-        
-        # Отправляем подтверждение
-        await message.reply(success_message)
+                await message.reply("⚠️ Не удалось исключить пользователя из беседы.")
+        else:
+            # Отправляем подтверждение
+            await message.reply(success_message)
             
     except Exception as e:
         logger.error(f"Ошибка при выдаче предупреждения: {e}")
@@ -879,29 +3430,13 @@ async def unwarn_command(message, args):
     target_mention = await get_user_mention(target_id, chat_id)
 
     try:
-        # Получаем последнее активное предупреждение пользователя
-        sql.execute("""
-            SELECT id FROM warns 
-            WHERE chat_id = ? AND user_id = ? AND active = 1 
-            ORDER BY warned_at DESC LIMIT 1
-        """, (chat_id, target_id))
-        warn_result = sql.fetchone()
+        # Снимаем последнее активное предупреждение и получаем новое количество
+        warn_count = await storage.remove_last_warn(chat_id, target_id)
         
-        if not warn_result:
+        if warn_count is None:
             await message.reply(f"❌ У {target_mention} нет активных предупреждений.")
             return
         
-        warn_id = warn_result[0]
-        
-        # Деактивируем предупреждение
-        sql.execute("UPDATE warns SET active = 0 WHERE id = ?", (warn_id,))
-        database.commit()
-        
-        # Получаем новое количество активных предупреждений
-        sql.execute("SELECT COUNT(*) FROM warns WHERE chat_id = ? AND user_id = ? AND active = 1", 
-                   (chat_id, target_id))
-        warn_count = sql.fetchone()[0]
-        
         await message.reply(f"✅ {initiator_mention} снял(а) предупреждение с {target_mention}.\nОсталось предупреждений: {warn_count}/3")
             
     except Exception as e:
@@ -919,14 +3454,7 @@ async def warn_list_command(message, args):
 
     try:
         # Получаем все активные предупреждения с подробной информацией
-        sql.execute("""
-            SELECT w.user_id, w.reason, w.warned_by, w.warned_at, u.nick
-            FROM warns w
-            LEFT JOIN users u ON w.user_id = u.user_id AND w.chat_id = u.chat_id
-            WHERE w.chat_id = ? AND w.active = 1 
-            ORDER BY w.warned_at DESC
-        """, (chat_id,))
-        warn_results = sql.fetchall()
+        warn_results = await storage.get_active_warns(chat_id)
         
         if not warn_results:
             await message.reply("📝 В этой беседе нет активных предупреждений.")
@@ -939,14 +3467,21 @@ async def warn_list_command(message, args):
                 user_warns[user_id] = []
             user_warns[user_id].append((reason, warned_by, warned_at, nick))
         
+        # Разрешаем всех упомянутых пользователей заранее, одним пакетом
+        mentions = await get_user_mentions(
+            {user_id for user_id, reason, warned_by, warned_at, nick in warn_results} |
+            {warned_by for user_id, reason, warned_by, warned_at, nick in warn_results},
+            chat_id
+        )
+        
         # Формируем список предупреждений
         warn_list = []
         for user_id, warns in user_warns.items():
-            user_mention = await get_user_mention(user_id, chat_id)
+            user_mention = mentions[user_id]
             warn_list.append(f"👤 {user_mention} - {len(warns)} предупреждений:")
             
             for i, (reason, warned_by, warned_at, nick) in enumerate(warns, 1):
-                warned_by_mention = await get_user_mention(warned_by, chat_id)
+                warned_by_mention = mentions[warned_by]
                 warned_at_str = datetime.fromtimestamp(warned_at).strftime("%Y-%m-%d %H:%M") if isinstance(warned_at, (int, float)) else str(warned_at)
                 
                 warn_list.append(f"   {i}. Выдал: {warned_by_mention}")
@@ -997,14 +3532,7 @@ async def warn_history_command(message, args):
 
     try:
         # Получаем последние 10 предупреждений пользователя
-        sql.execute("""
-            SELECT reason, warned_by, warned_at, active 
-            FROM warns 
-            WHERE chat_id = ? AND user_id = ? 
-            ORDER BY warned_at DESC 
-            LIMIT 10
-        """, (chat_id, target_id))
-        warn_results = sql.fetchall()
+        warn_results = await storage.get_warn_history(chat_id, target_id, 10)
         
         if not warn_results:
             await message.reply(f"📝 У {target_mention} нет истории предупреждений.")
@@ -1016,12 +3544,15 @@ async def warn_history_command(message, args):
         active_count = 0
         inactive_count = 0
         
+        # Разрешаем всех выдавших предупреждения заранее, одним пакетом
+        mentions = await get_user_mentions((warned_by for reason, warned_by, warned_at, active in warn_results), chat_id)
+        
         for i, (reason, warned_by, warned_at, active) in enumerate(warn_results, 1):
             status = "✅" if not active else "⚠️"
             status_text = "Снято" if not active else "Активно"
             
             # Получаем информацию о том, кто выдал предупреждение
-            warned_by_mention = await get_user_mention(warned_by, chat_id)
+            warned_by_mention = mentions[warned_by]
             
             # Форматируем время
             warned_at_str = datetime.fromtimestamp(warned_at).strftime("%Y-%m-%d %H:%M") if isinstance(warned_at, (int, float)) else str(warned_at)
@@ -1065,19 +3596,14 @@ async def leave_kick_command(message, args):
         return
 
     try:
-        # Получаем текущее состояние функции
-        sql.execute("SELECT leave_kick FROM chats WHERE chat_id = ?", (chat_id,))
-        result = sql.fetchone()
-        
-        current_leave_kick = result[0] if result else 1
+        state = get_chat_state(chat_id)
         
         # Переключаем функцию (0 -> 1, 1 -> 0)
-        new_leave_kick = 1 - current_leave_kick
+        new_leave_kick = 1 - state.leave_kick
         
-        # Обновляем значение в базе данных
-        sql.execute("UPDATE chats SET leave_kick = ? WHERE chat_id = ?", 
-                   (new_leave_kick, chat_id))
-        database.commit()
+        # Обновляем значение в хранилище, затем в кэше
+        await storage.set_leave_kick(chat_id, new_leave_kick)
+        state.leave_kick = new_leave_kick
         
         # Получаем упоминание инициатора
         initiator_mention = await get_user_mention(message.from_id, chat_id)
@@ -1107,10 +3633,9 @@ async def set_welcome_command(message, args):
     welcome_text = ' '.join(args)
     
     try:
-        # Обновляем приветственное сообщение в базе данных
-        sql.execute("UPDATE chats SET welcome_message = ? WHERE chat_id = ?", 
-                   (welcome_text, chat_id))
-        database.commit()
+        # Обновляем приветственное сообщение в хранилище
+        await storage.set_welcome_message(chat_id, welcome_text)
+        get_chat_state(chat_id).welcome_message = welcome_text
         
         # Получаем упоминание инициатора
         initiator_mention = await get_user_mention(message.from_id, chat_id)
@@ -1194,12 +3719,9 @@ async def ban_command(message, args):
         if ban_time_days is not None:
             end_time = int(time.time()) + ban_time_days * 24 * 60 * 60
 
-        # Добавляем бан в базу данных
-        sql.execute(
-            "INSERT OR REPLACE INTO bans (chat_id, user_id, end_time, reason, banned_by, banned_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (chat_id, target_id, end_time, reason, user_id, int(time.time()))
-        )
-        database.commit()
+        # Добавляем бан в хранилище
+        await storage.add_ban(chat_id, target_id, end_time, reason, user_id, int(time.time()))
+        ban_index.add(chat_id, target_id, end_time)
         
         # Формируем сообщение об успехе
         if ban_time_days is None:
@@ -1210,14 +3732,17 @@ async def ban_command(message, args):
         if reason:
             success_message += f" Причина: {reason}"
         
-        # Отправляем подтверждение
-        await message.reply(success_message)
-        
-        # Если пользователь в беседе, то кикаем его с помощью универсальной функции
+        # Если пользователь в беседе, то подтверждение и кик уходят одним execute
         if target_in_chat:
-            kick_success = await kick_user(peer_id, target_id, f"Бан: {reason}")
+            _, kick_success = await asyncio.gather(
+                message.reply(success_message),
+                kick_user(peer_id, target_id, f"Бан: {reason}")
+            )
             if not kick_success:
                 await message.reply("⚠️ Пользователь забанен, но не удалось его исключить из беседы.")
+        else:
+            # Отправляем подтверждение
+            await message.reply(success_message)
             
     except Exception as e:
         logger.error(f"Ошибка при бане пользователя: {e}")
@@ -1253,13 +3778,12 @@ async def unban_command(message, args):
     target_mention = await get_user_mention(target_id, chat_id)
 
     try:
-        # Удаляем бан из базы данных
-        sql.execute("DELETE FROM bans WHERE chat_id = ? AND user_id = ?", 
-                   (chat_id, target_id))
-        database.commit()
+        # Удаляем бан из хранилища
+        deleted = await storage.remove_ban(chat_id, target_id)
+        ban_index.remove(chat_id, target_id)
         
         # Проверяем, был ли пользователь забанен
-        if sql.rowcount > 0:
+        if deleted:
             await message.reply(f"✅ {initiator_mention} разбанил(а) {target_mention}.")
         else:
             await message.reply(f"❌ {target_mention} не был забанен.")
@@ -1330,19 +3854,12 @@ async def mute_command(message, args):
     target_mention = await get_user_mention(target_id, chat_id)
 
     try:
-        # Получаем ID группы бота
-        group_info = await bot.api.groups.get_by_id()
-        group_id = group_info.groups[0].id
-        
         # Вычисляем время окончания мута
         end_time = int(time.time()) + mute_time * 60
         
-        # Добавляем мут в базу данных
-        sql.execute(
-            "INSERT OR REPLACE INTO mutes (chat_id, user_id, end_time, reason) VALUES (?, ?, ?, ?)",
-            (chat_id, target_id, end_time, reason)
-        )
-        database.commit()
+        # Добавляем мут в хранилище
+        await storage.add_mute(chat_id, target_id, end_time, reason)
+        mute_registry.add(chat_id, target_id, end_time)
         
         # Формируем сообщение об успехе
         time_str = format_time(mute_time * 60)
@@ -1393,19 +3910,13 @@ async def unmute_command(message, args):
 
     try:
         # Проверяем, есть ли активный мут у пользователя
-        current_time = int(time.time())
-        sql.execute("SELECT * FROM mutes WHERE chat_id = ? AND user_id = ? AND end_time > ?", 
-                   (chat_id, target_id, current_time))
-        mute_result = sql.fetchone()
-        
-        if not mute_result:
+        if not mute_registry.is_muted(chat_id, target_id):
             await message.reply(f"❌ У {target_mention} нет активного мута.")
             return
         
-        # Удаляем мут из базы данных
-        sql.execute("DELETE FROM mutes WHERE chat_id = ? AND user_id = ?", 
-                   (chat_id, target_id))
-        database.commit()
+        # Удаляем мут из хранилища, затем из памяти
+        await storage.remove_mute(chat_id, target_id)
+        mute_registry.remove(chat_id, target_id)
         
         # Отправляем подтверждение
         await message.reply(f"✅ {initiator_mention} снял(а) мут с {target_mention}.")
@@ -1424,19 +3935,14 @@ async def silence_command(message, args):
         return
 
     try:
-        # Получаем текущее состояние режима тишины
-        sql.execute("SELECT silence FROM chats WHERE chat_id = ?", (chat_id,))
-        result = sql.fetchone()
-        
-        current_silence = result[0] if result else 0
+        state = get_chat_state(chat_id)
         
         # Переключаем режим тишины (0 -> 1, 1 -> 0)
-        new_silence = 1 - current_silence
+        new_silence = 1 - state.silence
         
-        # Обновляем значение в базе данных
-        sql.execute("UPDATE chats SET silence = ? WHERE chat_id = ?", 
-                   (new_silence, chat_id))
-        database.commit()
+        # Обновляем значение в хранилище, затем в кэше
+        await storage.set_silence(chat_id, new_silence)
+        state.silence = new_silence
         
         # Получаем упоминание инициатора
         initiator_mention = await get_user_mention(message.from_id, chat_id)
@@ -1476,6 +3982,11 @@ async def staff_command(message, args):
             PERMISSION_LEVELS['FOUR']: {"name": "Разработчики", "emoji": "🚀"}
         }
         
+        # Получаем профили всех участников одним запросом
+        profiles = await profile_resolver.get_many(
+            user_id for members in staff_members.values() for user_id, nick in members
+        )
+        
         # Формируем сообщение
         staff_message = "📋 Участники с правами в беседе:\n\n"
         
@@ -1492,16 +4003,8 @@ async def staff_command(message, args):
             staff_message += f"{level_emoji} {level_name}:\n"
             
             for user_id, nick in staff_members[level]:
-                # Получаем информацию о пользователе
-                try:
-                    users = await bot.api.users.get(user_ids=user_id)
-                    if users:
-                        user = users[0]
-                        full_name = f"{user.first_name} {user.last_name}"
-                    else:
-                        full_name = "Пользователь"
-                except Exception:
-                    full_name = "Пользователь"
+                profile = profiles.get(user_id)
+                full_name = f"{profile.first_name} {profile.last_name}" if profile else "Пользователь"
                 
                 # Используем ник, если он есть, иначе полное имя
                 display_name = nick if nick else full_name
@@ -1544,13 +4047,12 @@ async def id_command(message, args):
     
     try:
         # Получаем информацию о пользователе
-        users = await bot.api.users.get(user_ids=target_id)
-        if not users:
+        profile = await profile_resolver.get(target_id)
+        if not profile:
             await message.reply("❌ Пользователь не найден.")
             return
         
-        user = users[0]
-        user_name = f"{user.first_name} {user.last_name}"
+        user_name = f"{profile.first_name} {profile.last_name}"
         
         # Формируем сообщение
         response = (
@@ -1634,18 +4136,16 @@ async def nick_list_command(message, args):
             await message.reply("📝 В этой беседе никто не установил себе ник.")
             return
         
+        # Получаем имена и фамилии всех пользователей одним запросом
+        profiles = await profile_resolver.get_many(user_id for user_id, nick in nicks)
+        
         # Формируем список
         nick_list = []
         for user_id, nick in nicks:
-            # Для каждого пользователя получаем имя и фамилию
-            try:
-                users = await bot.api.users.get(user_ids=user_id)
-                if users:
-                    user = users[0]
-                    user_mention = f"[id{user_id}|{user.first_name} {user.last_name}]"
-                else:
-                    user_mention = f"[id{user_id}|Пользователь]"
-            except Exception:
+            profile = profiles.get(user_id)
+            if profile:
+                user_mention = f"[id{user_id}|{profile.first_name} {profile.last_name}]"
+            else:
                 user_mention = f"[id{user_id}|Пользователь]"
             
             nick_list.append(f"{user_mention} - {nick}")
@@ -1869,26 +4369,10 @@ async def remove_role_command(message, args):
     # Получаем информацию о целевом пользователе
     target_mention = await get_user_mention(target_id, chat_id)
     
-    # Сохраняем ник пользователя перед снятием прав
-    current_nick = await get_user_nick(target_id, chat_id)
-    
     # Устанавливаем нулевой уровень прав (ZERO) с сохранением ника
     try:
-        if current_nick is not None:
-            # Если есть ник, обновляем только уровень прав
-            sql.execute(
-                "UPDATE users SET permission_level = ? WHERE user_id = ? AND chat_id = ?",
-                (PERMISSION_LEVELS['ZERO'], target_id, chat_id)
-            )
-        else:
-            # Если ника нет, используем INSERT OR REPLACE
-            sql.execute(
-                """INSERT OR REPLACE INTO users (user_id, chat_id, permission_level) 
-                   VALUES (?, ?, ?)""",
-                (target_id, chat_id, PERMISSION_LEVELS['ZERO'])
-            )
-        
-        database.commit()
+        await storage.reset_permission(target_id, chat_id)
+        permission_cache.invalidate(target_id, chat_id)
         await message.reply(f"✅ {initiator_mention} успешно снял(а) все права с {target_mention}.")
     except Exception as e:
         logger.error(f"Ошибка при снятии прав: {e}")
@@ -2055,20 +4539,17 @@ async def clear_command(message, args):
     target_mention = await get_user_mention(target_id, chat_id)
 
     try:
-        # Получаем ID группы бота один раз
-        group_info = await bot.api.groups.get_by_id()
-        group_id = group_info.groups[0].id
+        # Сообщения, ещё лежащие в буфере, должны попасть в таблицу до чтения
+        await message_buffer.flush()
         
         # Если это ответ на конкретное сообщение - удаляем только его
         if delete_specific_message:
             # Удаляем конкретное сообщение
-            success = await delete_messages(peer_id, [specific_cmid], group_id)
+            success = await delete_messages(peer_id, [specific_cmid])
             
             if success:
-                # Удаляем запись из базы данных
-                sql.execute("DELETE FROM messages WHERE chat_id = ? AND user_id = ? AND cmid = ?", 
-                           (chat_id, target_id, specific_cmid))
-                database.commit()
+                # Удаляем запись из хранилища
+                await storage.delete_messages(chat_id, [specific_cmid])
                 
                 # Отправляем подтверждение
                 success_message = f"✅ {initiator_mention} удалил(а) сообщение от {target_mention}."
@@ -2078,30 +4559,34 @@ async def clear_command(message, args):
         # Иначе удаляем все сообщения пользователя
         else:
             # Получаем все cmid сообщений целевого пользователя
-            sql.execute("SELECT cmid FROM messages WHERE chat_id = ? AND user_id = ?", 
-                       (chat_id, target_id))
-            result = sql.fetchall()
+            result = await storage.get_user_messages(chat_id, target_id)
             
             if not result:
                 await message.reply(f"❌ Не найдено сообщений от {target_mention} для удаления.")
                 return
             
-            # Формируем список cmid
-            cmids = [row[0] for row in result]
+            # Пропускаем сообщения старше окна удаления: VK их уже не удалит
+            # (timestamp заполняется CURRENT_TIMESTAMP в UTC)
+            cutoff = (datetime.utcnow() - timedelta(seconds=DELETE_WINDOW_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+            cmids = [cmid for cmid, timestamp in result if timestamp is None or timestamp >= cutoff]
+            skipped_count = len(result) - len(cmids)
             
-            # Удаляем сообщения
-            success = await delete_messages(peer_id, cmids, group_id)
+            # Удаляем сообщения пачками
+            deleted_cmids = await delete_messages_bulk(peer_id, cmids)
             
-            if success:
-                # Удаляем записи из базы данных
-                sql.execute("DELETE FROM messages WHERE chat_id = ? AND user_id = ?", 
-                           (chat_id, target_id))
-                database.commit()
+            if deleted_cmids:
+                # Удаляем из хранилища только подтверждённые записи
+                await storage.delete_messages(chat_id, deleted_cmids)
                 
                 # Отправляем подтверждение
-                success_message = f"✅ {initiator_mention} удалил(а) {len(cmids)} сообщений от {target_mention}."
+                success_message = f"✅ {initiator_mention} удалил(а) {len(deleted_cmids)} сообщений от {target_mention}."
+                failed_count = len(cmids) - len(deleted_cmids)
+                if failed_count:
+                    success_message += f"\n⚠️ Не удалось удалить {failed_count} сообщений."
             else:
                 success_message = "❌ Не удалось удалить сообщения."
+            if skipped_count:
+                success_message += f"\nℹ️ Пропущено {skipped_count} сообщений старше 24 часов."
         
         # Отправляем сообщение об успехе (оно больше не будет удаляться)
         await message.reply(success_message)
@@ -2113,169 +4598,401 @@ async def clear_command(message, args):
 
 
 # Запуск бота
-if __name__ == "__main__":
-    initialize_bot()
-    logger.info("Бот запускается...")
+# Первые символы всех зарегистрированных команд: остальной текст не разбирается
+COMMAND_PREFIXES = frozenset(name[0] for name in commands)
+
+# Решения шлюза сообщений
+GATE_ALLOW = 0
+GATE_DELETE_MUTED = 1
+GATE_DELETE_SILENCE = 2
+
+async def message_gate(chat_id: int, user_id: int):
+    """
+    Решает, что делать с обычным сообщением: пропустить или удалить (мут, режим тишины).
+    Мут и тишина берутся из памяти, уровень прав - из кэша или одним запросом по первичному ключу,
+    и только когда в беседе включена тишина
+    :return: (решение, уровень прав или None, если он не понадобился)
+    """
+    if mute_registry.is_muted(chat_id, user_id):
+        return GATE_DELETE_MUTED, None
     
-    # Запускаем прослушиватель консоли в отдельном потоке
-    console_thread = threading.Thread(target=console_listener, daemon=True)
-    console_thread.start()
+    state = chat_states.get(chat_id)
+    if state is None or state.silence != 1:
+        return GATE_ALLOW, None
+    
+    user_level = await get_user_permission(user_id, chat_id)
+    if user_level == PERMISSION_LEVELS['ZERO']:
+        return GATE_DELETE_SILENCE, user_level
+    return GATE_ALLOW, user_level
 
-    @bot.on.chat_message(rules.ChatActionRule("chat_kick_user"))
-    async def handle_user_kick(message: Message):
-        """Обработчик события исключения пользователя из беседы"""
-        logger.info(f"Обработчик chat_kick_user сработал для пользователя {message.action.member_id}")
-        
-        user_id = message.action.member_id
-        chat_id = message.chat_id
-        peer_id = message.peer_id
-        
-        # Проверяем, активирован ли бот в этом чате
-        if not await check_chat(chat_id):
-            logger.info(f"Бот не активирован в чате {chat_id}, пропускаем обработку")
+async def handle_user_kick(message: Message):
+    """Обработчик события исключения пользователя из беседы"""
+    if log_sampler.sample('chat_action'):
+        logger.info("Обработчик chat_kick_user сработал для пользователя %s", message.action.member_id, extra={'event': 'chat_action'})
+
+    user_id = message.action.member_id
+    chat_id = message.chat_id
+    peer_id = message.peer_id
+
+    # Проверяем, активирован ли бот в этом чате
+    if not await check_chat(chat_id):
+        logger.info("Бот не активирован в чате %s, пропускаем обработку", chat_id)
+        return
+
+    # Если пользователь исключил сам себя, это эквивалентно выходу
+    if user_id == message.from_id:
+        logger.info("Пользователь %s исключил сам себя (эквивалентно выходу)", user_id)
+
+        # Проверяем, включена ли функция leave_kick
+        if get_chat_state(chat_id).leave_kick != 1:
+            logger.info("Функция leave_kick отключена в чате %s, пропускаем кик", chat_id)
             return
-        
-        # Если пользователь исключил сам себя, это эквивалентно выходу
-        if user_id == message.from_id:
-            logger.info(f"Пользователь {user_id} исключил сам себя (эквивалентно выходу)")
-            
-            # Проверяем, включена ли функция leave_kick
-            try:
-                sql.execute("SELECT leave_kick FROM chats WHERE chat_id = ?", (chat_id,))
-                result = sql.fetchone()
-                
-                leave_kick_enabled = result[0] if result else 1
-                
-                if leave_kick_enabled != 1:
-                    logger.info(f"Функция leave_kick отключена в чате {chat_id}, пропускаем кик")
-                    return
-            except Exception as e:
-                logger.error(f"Ошибка при проверке функции leave_kick: {e}")
-                return
-            
-            # Получаем информацию о пользователе
-            try:
-                user_mention = await get_user_mention(user_id, chat_id)
-                
-                # Пытаемся кикнуть пользователя
-                kick_success = await kick_user(peer_id, user_id, "Автоматический кик при выходе из беседы")
-                
-                if kick_success:
-                    logger.info(f"Пользователь {user_id} успешно кикнут после выхода")
-                    # Отправляем сообщение напрямую, не как ответ
-                    await bot.api.messages.send(
-                        peer_id=peer_id,
-                        message=f"{user_mention} вышел(а) из беседы и был(а) кикнут(а).",
-                        random_id=0
-                    )
-                else:
-                    logger.info(f"Не удалось кикнуть пользователя {user_id} после выхода")
-                    # Отправляем сообщение напрямую, не как ответ
-                    await bot.api.messages.send(
-                        peer_id=peer_id,
-                        message=f"{user_mention} вышел(а) из беседы, но не удалось его кикнуть.",
-                        random_id=0
-                    )
-                    
-            except Exception as e:
-                logger.error(f"Ошибка при обработке выхода пользователя: {e}")
-        else:
-            logger.info(f"Пользователь {user_id} был исключен пользователем {message.from_id}, это не выход")
-        
-        # Обработчики событий входа пользователей (должны быть зарегистрированы ДО основного обработчика)
-    @bot.on.chat_message(rules.ChatActionRule("chat_invite_user_by_link"))
-    async def handle_user_join_by_link(message: Message):
-        logger.info(f"Обработчик chat_invite_user_by_link сработал для пользователя {message.action.member_id}")
-        user_id = message.action.member_id
+
+        # Получаем информацию о пользователе
+        try:
+            user_mention = await get_user_mention(user_id, chat_id)
+
+            # Пытаемся кикнуть пользователя
+            kick_success = await kick_user(peer_id, user_id, "Автоматический кик при выходе из беседы")
+
+            if kick_success:
+                logger.info("Пользователь %s успешно кикнут после выхода", user_id)
+                # Отправляем сообщение напрямую, не как ответ
+                await bot.api.messages.send(
+                    peer_id=peer_id,
+                    message=f"{user_mention} вышел(а) из беседы и был(а) кикнут(а).",
+                    random_id=0
+                )
+            else:
+                logger.info("Не удалось кикнуть пользователя %s после выхода", user_id)
+                # Отправляем сообщение напрямую, не как ответ
+                await bot.api.messages.send(
+                    peer_id=peer_id,
+                    message=f"{user_mention} вышел(а) из беседы, но не удалось его кикнуть.",
+                    random_id=0
+                )
+
+        except Exception as e:
+            logger.error("Ошибка при обработке выхода пользователя: %s", e)
+    else:
+        logger.info("Пользователь %s был исключен пользователем %s, это не выход", user_id, message.from_id)
+
+async def handle_user_join_by_link(message: Message):
+    if log_sampler.sample('chat_action'):
+        logger.info("Обработчик chat_invite_user_by_link сработал для пользователя %s", message.action.member_id, extra={'event': 'chat_action'})
+    user_id = message.action.member_id
+    if join_batcher.enabled:
+        # Не держим очередь беседы: вход проверится вместе с остальными за окно
+        join_batcher.add(message.chat_id, message.peer_id, user_id)
+    else:
         await check_ban_and_kick(message, user_id)
 
-    @bot.on.chat_message(rules.ChatActionRule("chat_invite_user"))
-    async def handle_user_join(message: Message):
-        logger.info(f"Обработчик chat_invite_user сработал для пользователя {message.action.member_id}")
-        user_id = message.action.member_id
+async def handle_user_join(message: Message):
+    if log_sampler.sample('chat_action'):
+        logger.info("Обработчик chat_invite_user сработал для пользователя %s", message.action.member_id, extra={'event': 'chat_action'})
+    user_id = message.action.member_id
+    if join_batcher.enabled:
+        # Не держим очередь беседы: вход проверится вместе с остальными за окно
+        join_batcher.add(message.chat_id, message.peer_id, user_id)
+    else:
         await check_ban_and_kick(message, user_id)
+
+async def combined_handler(message: Message):
+    metrics.inc('vkbot_messages_total')
+    # Логируем входящие сообщения для отладки (выборочно, см. log_sample_rates)
+    if log_sampler.sample('message'):
+        logger.info("Получено сообщение: %s от пользователя %s в чате %s", message.text, message.from_id, message.chat_id,
+                    extra={'event': 'message'})
+
+    chat_id = message.chat_id
+    user_id = message.from_id
     
-    # Регистрируем обработчик для сохранения сообщений и обработки команд
-    @bot.on.chat_message()
-    async def combined_handler(message: Message):
-        # Логируем все входящие сообщения для отладки
-        logger.info(f"Получено сообщение: {message.text} от пользователя {message.from_id} в чате {message.chat_id}")
-        
-        # Проверяем, не находится ли пользователь в муте
-        current_time = int(time.time())
-        chat_id = message.chat_id
-        user_id = message.from_id
+    # Сначала дешёвые проверки: мут и тишина решаются по памяти, права - не больше чем одним запросом
+    action, user_level = await message_gate(chat_id, user_id)
+    if action != GATE_ALLOW:
+        try:
+            await delete_messages(message.peer_id, [message.conversation_message_id])
+        except Exception as e:
+            if action == GATE_DELETE_MUTED:
+                logger.error("Ошибка при удалении сообщения замученного пользователя: %s", e)
+            else:
+                logger.error("Ошибка при удалении сообщения в режиме тишины: %s", e)
+        return
+    
+    # Сохраняем сообщение в базу данных (через буфер отложенной записи)
+    if message.conversation_message_id and chat_id:
+        message_buffer.add(chat_id, user_id, message.conversation_message_id)
+    
+    # Обрабатываем команды: обычный текст отсекается по первому непробельному символу без разбора строки
+    text = message.text
+    if not text or text.lstrip()[:1] not in COMMAND_PREFIXES:
+        return
+
+    parts = text.split()
+    command = parts[0].lower()
+    args = parts[1:] if len(parts) > 1 else []
+    
+    if command in commands:
+        func, required_level = commands[command]
+        if user_level is None:
+            user_level = await get_user_permission(user_id, chat_id)
         
-        # Проверяем активные муты для этого пользователя
-        sql.execute("SELECT end_time FROM mutes WHERE chat_id = ? AND user_id = ? AND end_time > ?", 
-                   (chat_id, user_id, current_time))
-        mute_result = sql.fetchone()
+        if user_level >= required_level:
+            await func(message, args)
+        else:
+            await message.reply("❌ Недостаточно прав для выполнения этой команды!")
+
+def register_handlers(bot: Bot):
+    """Подключает обработчики событий беседы к боту"""
+    # Обработчики событий входа пользователей (должны быть зарегистрированы ДО основного обработчика)
+    bot.on.chat_message(rules.ChatActionRule("chat_kick_user"))(handle_user_kick)
+    bot.on.chat_message(rules.ChatActionRule("chat_invite_user_by_link"))(handle_user_join_by_link)
+    bot.on.chat_message(rules.ChatActionRule("chat_invite_user"))(handle_user_join)
+    # Обработчик для сохранения сообщений и обработки команд
+    bot.on.chat_message()(combined_handler)
+
+def event_peer_id(event: dict) -> int:
+    """peer_id события Long Poll (0, если у события нет беседы)"""
+    obj = event.get('object') or {}
+    message = obj.get('message') if isinstance(obj.get('message'), dict) else obj
+    return message.get('peer_id') or 0
+
+def run_worker(shard_index: int, shard_count: int, events):
+    """
+    Процесс-обработчик шарда: получает события своих бесед из очереди events
+    и обрабатывает их теми же обработчиками, что и обычный режим. None в очереди - остановка
+    """
+    global SHARD_INDEX, SHARD_COUNT, METRICS_PORT, outbound_scheduler
+    # Ctrl+C обрабатывает процесс чтения, он и останавливает обработчики
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    SHARD_INDEX, SHARD_COUNT = shard_index, shard_count
+    if METRICS_PORT:
+        # У каждого обработчика свои метрики на следующем по счёту порту
+        METRICS_PORT += 1 + shard_index
+    # Лимит запросов VK общий на группу, поэтому делится между процессами
+    outbound_scheduler = OutboundScheduler(
+        VK_REQUESTS_PER_SECOND / shard_count,
+        max(1, getattr(Config, 'vk_requests_burst', max(1, VK_REQUESTS_PER_SECOND // 4)) // shard_count)
+    )
+    
+    initialize_bot()
+    register_handlers(bot)
+    
+    async def serve():
+        await resolve_bot_context()
+        background = [
+            asyncio.ensure_future(mute_expiry_worker()),
+            asyncio.ensure_future(ban_expiry_worker()),
+            asyncio.ensure_future(message_buffer.run()),
+            asyncio.ensure_future(start_metrics_server()),
+        ]
+        if shard_index == 0:
+            # Очистка общая для всей базы, достаточно одного процесса
+            background.append(asyncio.ensure_future(message_retention.run()))
         
-        if mute_result:
-            # Пользователь в муте - удаляем сообщение
+        loop = asyncio.get_running_loop()
+        logger.info("Обработчик шарда %s/%s запущен", shard_index, shard_count)
+        try:
+            while True:
+                event = await loop.run_in_executor(None, events.get)
+                if event is None:
+                    break
+                chat_dispatcher.submit(event, bot.api)
+        finally:
+            # Дорабатываем начатые события и входы из окна join_batcher, сбрасываем буфер сообщений
+            await chat_dispatcher.close()
+            await join_batcher.flush()
+            await message_buffer.flush()
+            for task in background:
+                task.cancel()
+    
+    try:
+        asyncio.run(serve())
+    finally:
+        shutdown_database()
+        logger.info("Обработчик шарда %s/%s остановлен", shard_index, shard_count)
+
+class ShardSupervisor:
+    """
+    Процесс чтения Long Poll: раскладывает события по процессам-обработчикам
+    по хэшу peer_id, перезапускает упавшие обработчики и останавливает их по команде
+    """
+
+    RESTART_DELAY = 1.0
+    READER_MAX_DELAY = 60.0
+    STOP_TIMEOUT = 30
+
+    def __init__(self, shard_count: int):
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(shard_count)]
+        self.processes = [None] * shard_count
+        self.restarts = 0
+        self.reader_restarts = 0
+        self.dropped_events = 0
+        self._stopping = None
+
+    def start_worker(self, shard_index: int):
+        process = self.context.Process(
+            target=run_worker,
+            args=(shard_index, self.shard_count, self.queues[shard_index]),
+            name=f"shard-{shard_index}",
+            daemon=False
+        )
+        process.start()
+        self.processes[shard_index] = process
+        logger.info("Запущен обработчик шарда %s (pid %s)", shard_index, process.pid)
+
+    def dispatch(self, event: dict):
+        shard_index = shard_for_peer(event_peer_id(event), self.shard_count)
+        self.queues[shard_index].put(event)
+
+    async def watch_workers(self):
+        """Перезапускает обработчики, которые завершились не по команде остановки"""
+        while not self._stopping.is_set():
+            for shard_index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Обработчик шарда %s завершился с кодом %s, перезапуск",
+                                 shard_index, process.exitcode)
+                    self.restarts += 1
+                    # События в очереди шарда сохраняются и достанутся новому процессу
+                    self.start_worker(shard_index)
             try:
-                group_info = await bot.api.groups.get_by_id()
-                group_id = group_info.groups[0].id
-                await delete_messages(message.peer_id, [message.conversation_message_id], group_id)
-                return  # Прекращаем обработку сообщения
+                await asyncio.wait_for(self._stopping.wait(), self.RESTART_DELAY)
+            except asyncio.TimeoutError:
+                pass
+
+    async def read_events(self, api: API):
+        polling = BotPolling(api)
+        async for event in polling.listen():
+            for update in event.get('updates', []):
+                try:
+                    self.dispatch(update)
+                except Exception as e:
+                    self.dropped_events += 1
+                    logger.error("Не удалось передать событие обработчику шарда: %s", e)
+
+    async def supervise_reader(self, api: API):
+        """
+        Перезапускает чтение Long Poll, если оно упало: первый get_server()
+        выполняется вне цикла повторов BotPolling (VK недоступен при старте,
+        неверный токен). Пауза между попытками растёт до READER_MAX_DELAY
+        """
+        delay = self.RESTART_DELAY
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                await self.read_events(api)
+                logger.error("Чтение Long Poll неожиданно завершилось, перезапуск через %.0f с", delay)
             except Exception as e:
-                logger.error(f"Ошибка при удалении сообщения замученного пользователя: {e}")
-            return
+                logger.error("Ошибка чтения Long Poll: %s, перезапуск через %.0f с", e, delay)
+            self.reader_restarts += 1
+            # После долгой нормальной работы начинаем паузы заново
+            if time.monotonic() - started > self.READER_MAX_DELAY:
+                delay = self.RESTART_DELAY
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.READER_MAX_DELAY)
+
+    def stop_workers(self):
+        """Просит обработчики доработать очередь и дожидается их завершения"""
+        for events in self.queues:
+            events.put(None)
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for shard_index, process in enumerate(self.processes):
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Обработчик шарда %s не завершился вовремя, принудительная остановка", shard_index)
+                process.terminate()
+                process.join()
+
+    async def serve(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
         
-        # Удаляем истекшие муты
-        sql.execute("DELETE FROM mutes WHERE end_time <= ?", (current_time,))
-        database.commit()
+        # Команда stop из консоли приходит из другого потока
+        console_thread = threading.Thread(
+            target=console_listener,
+            args=(lambda: loop.call_soon_threadsafe(self._stopping.set),),
+            daemon=True
+        )
+        console_thread.start()
         
-        # Проверяем режим тишины
-        try:
-            sql.execute("SELECT silence FROM chats WHERE chat_id = ?", (chat_id,))
-            result = sql.fetchone()
-            
-            silence_mode = result[0] if result else 0
-            
-            # Если включен режим тишины и у пользователя уровень прав 0
-            if silence_mode == 1:
-                user_level = await get_user_permission(user_id, chat_id)
-                if user_level == PERMISSION_LEVELS['ZERO']:
-                    # Удаляем сообщение
-                    try:
-                        group_info = await bot.api.groups.get_by_id()
-                        group_id = group_info.groups[0].id
-                        await delete_messages(message.peer_id, [message.conversation_message_id], group_id)
-                        return  # Прекращаем обработку сообщения
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении сообщения в режиме тишины: {e}")
-                        return
-        except Exception as e:
-            logger.error(f"Ошибка при проверке режима тишины: {e}")
+        api = ScheduledAPI(vk_token)
+        if VK_API_URL:
+            api.API_URL = VK_API_URL
         
-        # Сохраняем сообщение в базу данных
+        tasks = [
+            asyncio.ensure_future(self.supervise_reader(api)),
+            asyncio.ensure_future(self.watch_workers()),
+        ]
+        stopping = asyncio.ensure_future(self._stopping.wait())
         try:
-            if message.conversation_message_id and message.chat_id:
-                sql.execute(
-                    "INSERT OR IGNORE INTO messages (chat_id, user_id, cmid) VALUES (?, ?, ?)",
-                    (message.chat_id, message.from_id, message.conversation_message_id)
-                )
-                database.commit()
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении сообщения: {e}")
-        
-        # Обрабатываем команды
-        if not message.text:
-            return
+            # Фоновые задачи сами не завершаются: если какая-то всё же умерла,
+            # без неё супервизор бесполезен, поэтому останавливаемся
+            done, _ = await asyncio.wait([stopping, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stopping:
+                    logger.error("Фоновая задача супервизора завершилась: %s, остановка",
+                                 task.exception() if not task.cancelled() else "отменена")
+        finally:
+            stopping.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-        parts = message.text.split()
-        command = parts[0].lower()
-        args = parts[1:] if len(parts) > 1 else []
+    def run(self):
+        global database
+        if not isinstance(storage, SQLiteStorage):
+            logger.error("Режим шардирования работает только с storage_backend = 'sqlite'")
+            return
+        # Схему и миграции применяем один раз здесь, а не наперегонки в каждом обработчике
+        database = sqlite3.connect(DATABASE_PATH)
+        try:
+            configure_connection(database)
+            init_db()
+        finally:
+            database.close()
+            database = None
         
-        if command in commands:
-            func, required_level = commands[command]
-            user_level = await get_user_permission(message.from_id, message.chat_id)
-            
-            if user_level >= required_level:
-                await func(message, args)
-            else:
-                await message.reply("❌ Недостаточно прав для выполнения этой команды!")
+        for shard_index in range(self.shard_count):
+            self.start_worker(shard_index)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Получен сигнал остановки")
+        finally:
+            logger.info("Останавливаем обработчики шардов...")
+            self.stop_workers()
+            logger.info("Бот остановлен, перезапусков обработчиков: %s, чтения Long Poll: %s, потеряно событий: %s",
+                        self.restarts, self.reader_restarts, self.dropped_events)
+
+if __name__ == "__main__" and WORKER_PROCESSES > 0:
+    logger.info("Бот запускается в режиме шардирования: %s процессов-обработчиков", WORKER_PROCESSES)
+    ShardSupervisor(WORKER_PROCESSES).run()
+
+elif __name__ == "__main__":
+    initialize_bot()
+    # ID группы получаем один раз при запуске цикла событий
+    bot.loop_wrapper.on_startup.append(resolve_bot_context())
+    # При остановке (Ctrl+C) проверяем входы, оставшиеся в окне join_batcher
+    bot.loop_wrapper.on_shutdown.append(join_batcher.flush())
+    logger.info("Бот запускается...")
+    
+    # Запускаем прослушиватель консоли в отдельном потоке
+    console_thread = threading.Thread(target=console_listener, daemon=True)
+    console_thread.start()
+    
+    # Фоновые задачи
+    bot.loop_wrapper.add_task(mute_expiry_worker())
+    bot.loop_wrapper.add_task(ban_expiry_worker())
+    bot.loop_wrapper.add_task(message_buffer.run())
+    bot.loop_wrapper.add_task(message_retention.run())
+    bot.loop_wrapper.add_task(start_metrics_server())
+
+    register_handlers(bot)
     
     try:
         # Запускаем бота
@@ -2286,5 +5003,4 @@ if __name__ == "__main__":
     finally:
         logger.info("Бот остановлен")
         # Закрываем соединение с базой данных
-        if database:
-            database.close()
\ No newline at end of file
+        shutdown_database()
\ No newline at end of file
@@ -0,0 +1,40 @@
+"""
+Частые запросы (main.HOT_QUERIES) должны выполняться по индексам,
+которые создают миграции. Запуск из корня репозитория: python -m pytest
+"""
+import os
+import sqlite3
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # config.py с токеном в репозиторий не входит, для проверки схемы токен не нужен
+    config = types.ModuleType("config")
+    config.Config = type("Config", (), {"vk_token": "test"})
+    sys.modules["config"] = config
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def migrated_database(tmp_path, monkeypatch):
+    connection = sqlite3.connect(str(tmp_path / "bot.db"))
+    monkeypatch.setattr(main, "database", connection)
+    main.init_db()
+    yield connection
+    connection.close()
+
+
+def test_migrations_applied(migrated_database):
+    version = migrated_database.execute("PRAGMA user_version").fetchone()[0]
+    assert version == len(main.MIGRATIONS)
+
+
+def test_hot_queries_use_indexes(migrated_database):
+    assert main.find_unindexed_queries(migrated_database) == []